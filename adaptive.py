@@ -0,0 +1,66 @@
+from builtins import object
+import logging
+
+
+class AdaptiveInterval(object):
+    """
+    Picks the polling interval of a device between min_interval and max_interval. The interval is halved while any
+    probe changes at least 'rate' degrees per minute, and drops to min_interval when a probe is within 'margin'
+    degrees of its threshold. While all probes change less than a quarter of 'rate', it grows by half its length.
+    """
+
+    growth = 1.5
+
+    def __init__(self, min_interval, max_interval, rate=1.0, margin=5, thresholds=None, initial_interval=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = rate
+        self.margin = margin
+        # Configured thresholds, by probe number. Thresholds read from the device are merged in by update()
+        self.thresholds = thresholds or {}
+        self.current = self.clamp(initial_interval if initial_interval is not None else min_interval)
+        self.last = None
+
+    def clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    @staticmethod
+    def numeric(temperatures):
+        return {probe: value for probe, value in temperatures.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+    def near_threshold(self, temperatures, thresholds):
+        return any(probe in thresholds and abs(thresholds[probe] - value) <= self.margin
+                   for probe, value in temperatures.items())
+
+    def max_rate(self, timestamp, temperatures):
+        """Largest change of any probe since the last update, in degrees per minute"""
+        if self.last is None:
+            return None
+        last_timestamp, last_temperatures = self.last
+        elapsed = timestamp - last_timestamp
+        if elapsed <= 0:
+            return None
+        return max([abs(value - last_temperatures[probe]) * 60.0 / elapsed
+                    for probe, value in temperatures.items() if probe in last_temperatures] or [0.0])
+
+    def update(self, timestamp, temperatures, device_thresholds=None):
+        """Updates the interval from a new temperature reading, and returns it"""
+        temperatures = self.numeric(temperatures)
+        thresholds = dict(device_thresholds or {})
+        thresholds.update(self.thresholds)
+        rate = self.max_rate(timestamp, temperatures)
+        self.last = (timestamp, temperatures)
+
+        previous = self.current
+        if self.near_threshold(temperatures, thresholds):
+            self.current = self.min_interval
+        elif rate is not None and rate >= self.rate:
+            self.current = self.clamp(self.current / 2.0)
+        elif rate is not None and rate < self.rate / 4.0:
+            self.current = self.clamp(self.current * self.growth)
+
+        if self.current != previous:
+            logging.debug("Polling interval changed from {:.1f} to {:.1f} seconds (rate: {} degrees/min)".format(
+                previous, self.current, rate))
+        return self.current
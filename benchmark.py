@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Runs simulated devices through the full read and publish pipeline against a local MQTT stand-in, and optionally a
+local InfluxDB stand-in, and reports throughput, publish latency, CPU and memory usage.
+"""
+
+from builtins import object
+import argparse
+from gzip import decompress
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import logging
+import resource
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+from engine import AsyncEngine
+from handlecache import HandleCache
+from scheduler import ConnectionScheduler
+from sinks import BufferedSink, MqttSink, MultiSink, Sink
+import simulator
+import utils
+
+
+class StandInMessageInfo(object):
+    rc = 0
+
+
+class StandInMqttClient(object):
+    """
+    Local stand-in for paho's mqtt.Client, counting messages instead of sending them to a broker
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.payload_bytes = 0
+
+    def publish(self, topic, payload):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.messages += 1
+            self.payload_bytes += len(str(payload))
+        return StandInMessageInfo()
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class StandInInfluxHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between writes, like InfluxDB
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count(connections=1)
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers['Content-Length']))
+        size = len(payload)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            payload = decompress(payload)
+        self.server.count(requests=1, lines=payload.count(b'\n'), payload_bytes=size)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("InfluxDB stand-in: " + format % args)
+
+
+class StandInInfluxServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the InfluxDB write endpoint, counting connections, writes and lines instead of storing them
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInInfluxHandler)
+        self.lock = threading.Lock()
+        self.counts = {'connections': 0, 'requests': 0, 'lines': 0, 'payload_bytes': 0}
+        self.thread = threading.Thread(target=self.serve_forever, name='InfluxStandIn')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/write?db=benchmark".format(self.server_address[1])
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+
+class LatencyRecorder(Sink):
+    """
+    Wraps a sink, recording the time between taking each reading and it being published
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.latencies = []
+
+    def connect(self):
+        self.sink.connect()
+
+    def publish(self, reading):
+        self.sink.publish(reading)
+        self.latencies.append(time.time() - reading.timestamp)
+
+    def close(self):
+        self.sink.close()
+
+
+def percentile(values, percent):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def device_configs(options):
+    return [{'name': "sim{}".format(i),
+             'type': "simulated_{}".format(options.device_type),
+             'address': "5E:00:00:00:{:02X}:{:02X}".format(i // 256, i % 256),
+             'topic': 'benchmark',
+             'interval': options.interval,
+             'notifications': options.notifications,
+             'simulation': {'latency': options.gatt_latency, 'drop_rate': options.drop_rate,
+                            'read_error_rate': options.read_error_rate}}
+            for i in range(options.devices)]
+
+
+def run(options):
+    simulator.register()
+    client = StandInMqttClient(options.broker_latency)
+    recorder = LatencyRecorder(MqttSink(client, options.payload_format))
+    sink = BufferedSink(recorder, max_queue_size=options.devices * 10)
+    influx_server = None
+    if options.influx:
+        from influx import InfluxSink
+        influx_server = StandInInfluxServer()
+        sink = MultiSink([sink, InfluxSink(influx_server.url, batch_size=options.influx_batch_size,
+                                           flush_interval=options.influx_flush_interval)])
+    handle_cache = HandleCache()
+    scheduler = ConnectionScheduler(max_concurrent_connections=options.max_concurrent_connections)
+    configs = device_configs(options)
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    if options.engine == 'asyncio':
+        monitors = utils.get_device_monitors(configs, sink, handle_cache, scheduler)
+        AsyncEngine(monitors, options.workers).run(timeout=options.duration)
+        threads = 2 * options.workers
+    else:
+        run_event = threading.Event()
+        run_event.set()
+        devices = utils.get_device_threads(configs, sink, run_event, handle_cache, scheduler)
+        for device in devices:
+            device.start()
+        time.sleep(options.duration)
+        threads = threading.active_count()
+        run_event.clear()
+        for device in devices:
+            device.join()
+    elapsed = time.time() - start
+    sink.close()
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    cpu = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+    latencies = recorder.latencies
+    print("engine:             {}".format(options.engine))
+    print("devices:            {}".format(options.devices))
+    print("threads:            {}".format(threads))
+    print("duration:           {:.1f} s".format(elapsed))
+    print("readings:           {} ({:.1f}/s)".format(len(latencies), len(latencies) / elapsed))
+    print("mqtt messages:      {} ({:.1f}/s, {} payload bytes)".format(client.messages, client.messages / elapsed,
+                                                                        client.payload_bytes))
+    if influx_server:
+        counts = influx_server.counts
+        print("influxdb writes:    {} ({} lines, {} gzipped payload bytes, {} connections)".format(
+            counts['requests'], counts['lines'], counts['payload_bytes'], counts['connections']))
+        influx_server.shutdown()
+    print("publish latency:    p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms".format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies or [float('nan')]) * 1000))
+    print("cpu:                {:.2f} s ({:.1f}% of one core)".format(cpu, 100 * cpu / elapsed))
+    # ru_maxrss is in kilobytes on Linux
+    print("max rss:            {:.1f} MB".format(end_usage.ru_maxrss / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the monitor pipeline with simulated igrill devices')
+    parser.add_argument('-n', '--devices', action='store', dest='devices', default=10, type=int,
+                        help='Number of simulated devices, default: 10')
+    parser.add_argument('-t', '--duration', action='store', dest='duration', default=30, type=float,
+                        help='Seconds to run, default: 30')
+    parser.add_argument('-i', '--interval', action='store', dest='interval', default=1, type=float,
+                        help='Polling interval of every device, default: 1')
+    parser.add_argument('--device-type', action='store', dest='device_type', default='igrill_v2',
+                        choices=['igrill_mini', 'igrill_v2', 'igrill_v3', 'pulse_2000'],
+                        help='Device type to simulate, default: \'igrill_v2\'')
+    parser.add_argument('--notifications', action='store_true', dest='notifications',
+                        help='Use temperature notifications instead of reads')
+    parser.add_argument('--gatt-latency', action='store', dest='gatt_latency', default=0.01, type=float,
+                        help='Seconds added to every simulated GATT operation, default: 0.01')
+    parser.add_argument('--drop-rate', action='store', dest='drop_rate', default=0.0, type=float,
+                        help='Probability of a link drop per GATT operation, default: 0')
+    parser.add_argument('--read-error-rate', action='store', dest='read_error_rate', default=0.0, type=float,
+                        help='Probability of a read failing without a link drop, default: 0')
+    parser.add_argument('--broker-latency', action='store', dest='broker_latency', default=0.0, type=float,
+                        help='Seconds added to every publish to the MQTT stand-in, default: 0')
+    parser.add_argument('--payload-format', action='store', dest='payload_format', default='topics',
+                        help='MQTT payload format, default: \'topics\'')
+    parser.add_argument('--influx', action='store_true', dest='influx',
+                        help='Also publish to a local InfluxDB stand-in')
+    parser.add_argument('--influx-batch-size', action='store', dest='influx_batch_size', default=5000, type=int,
+                        help='Lines per InfluxDB write, default: 5000')
+    parser.add_argument('--influx-flush-interval', action='store', dest='influx_flush_interval', default=10, type=int,
+                        help='Seconds between InfluxDB writes, default: 10')
+    parser.add_argument('--max-concurrent-connections', action='store', dest='max_concurrent_connections', default=1,
+                        type=int, help='Concurrent connection attempts, default: 1')
+    parser.add_argument('-e', '--engine', action='store', dest='engine', default='threads', choices=['threads', 'asyncio'],
+                        help='Engine to run the devices with, default: \'threads\'')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', default=4, type=int,
+                        help='Bluetooth worker threads for the asyncio engine, default: 4')
+    parser.add_argument('-l', '--log-level', action='store', dest='log_level', default='WARNING',
+                        help='Set log level, default: \'warning\'')
+    options = parser.parse_args()
+
+    utils.log_setup(options.log_level, '')
+    run(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 from builtins import object
+import copy
 import logging
 import os
+import re
 import yaml
 from yamlreader import yaml_load
 
@@ -11,7 +13,8 @@ def read_config(config_path, defaults):
         raise ValueError("{0} is not a directory".format(config_path))
 
     try:
-        return yaml_load(config_path, defaults)
+        # yaml_load merges into the defaults it is given, so every read gets its own copy
+        return yaml_load(config_path, copy.deepcopy(defaults))
     except yaml.YAMLError:
         logging.exception("Failed to read YAML config from directory: {0}".format(config_path))
 
@@ -20,66 +23,173 @@ def strip_config(config, allowed_keys):
     return {k: v for k, v in config.items() if k in allowed_keys and v}
 
 
+# Formats string entries can be required to have, with the description used in errors
+FORMATS = {'mac': (re.compile(r'^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$'), 'a MAC address like 00:11:22:AA:BB:CC')}
+
+
+class FrozenDict(dict):
+    """
+    Read only dict, used for loaded configs so they can be shared by all threads without copying
+    """
+
+    def readonly(self, *args, **kwargs):
+        raise TypeError("Config is read only")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = readonly
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def matches(value, expected):
+    expected = expected if isinstance(expected, tuple) else (expected,)
+    # bool is a subclass of int, but True is no number of seconds
+    if isinstance(value, bool) and bool not in expected:
+        return False
+    return isinstance(value, expected)
+
+
+def type_name(expected):
+    if isinstance(expected, tuple):
+        return ' or '.join(t.__name__ for t in expected)
+    return expected.__name__
+
+
+class Schema(object):
+    """
+    Config requirements compiled into a validator. Validating collects every error instead of stopping at the
+    first, fills in defaults and returns the config frozen. Besides 'required_entries', 'optional_entries' and
+    'list_type', specs can have:
+        'defaults': {key: value}     Values of optional entries that are not set
+        'choices': {key: [values]}   Allowed values of an entry
+        'combinations': {key: (separator, [values])}
+                                     Allowed values of each part of a string entry, like 'json+topics'
+        'formats': {key: format}     Format of a string entry, one of FORMATS
+        'unique': [keys]             Entries of a list of dicts whose values may not repeat, like device names
+    """
+
+    compiled = {}
+
+    @classmethod
+    def compile(cls, requirements):
+        """Returns the schema for the given requirements, compiling them only once"""
+        key = id(requirements)
+        if key not in cls.compiled:
+            cls.compiled[key] = (requirements, cls(requirements))
+        return cls.compiled[key][1]
+
+    def __init__(self, requirements):
+        specs = requirements.get('specs', {})
+        self.required = specs.get('required_entries', {})
+        self.entries = dict(specs.get('optional_entries', {}))
+        self.entries.update(self.required)
+        self.list_type = specs.get('list_type')
+        self.minimum = requirements.get('minimum')
+        self.defaults = specs.get('defaults', {})
+        self.choices = specs.get('choices', {})
+        self.combinations = specs.get('combinations', {})
+        self.unique = specs.get('unique', ())
+        self.formats = {key: FORMATS[name] for key, name in specs.get('formats', {}).items()}
+        self.children = {key: Schema(child) for key, child in requirements.get('children', {}).items()}
+
+    def validate(self, path, value, errors):
+        """Returns the validated value, frozen, appending a message for every problem found to errors"""
+        if isinstance(value, dict):
+            return self.validate_dict(path, value, errors)
+        if isinstance(value, list):
+            return self.validate_list(path, value, errors)
+        return value
+
+    def validate_dict(self, path, config, errors):
+        result = {}
+        for key, value in config.items():
+            entry_path = "{}.{}".format(path, key) if path else key
+            if key not in self.entries:
+                logging.warning("Ignoring unknown config entry '{}'".format(entry_path))
+                continue
+            expected = self.entries[key]
+            if value is None and key in self.children and expected is dict and key not in self.required:
+                # An empty section uses the defaults, 'tls:' for example enables TLS with default settings. Its
+                # required entries are still missing
+                value = {}
+            if value is None:
+                if key not in self.required:
+                    result[key] = None
+                continue
+
+            if not matches(value, expected):
+                errors.append("'{}' must be {}, was {}".format(entry_path, type_name(expected), type(value).__name__))
+                continue
+            if key in self.choices and value not in self.choices[key]:
+                errors.append("'{}' must be one of {}, was '{}'".format(entry_path, ', '.join(self.choices[key]), value))
+            if key in self.combinations:
+                separator, choices = self.combinations[key]
+                for part in value.split(separator):
+                    if part not in choices:
+                        errors.append("'{}' must be a '{}' separated combination of {}, '{}' is not one of them"
+                                      .format(entry_path, separator, ', '.join(choices), part))
+            if key in self.formats and not self.formats[key][0].match(value):
+                errors.append("'{}' must be {}, was '{}'".format(entry_path, self.formats[key][1], value))
+            result[key] = self.children[key].validate(entry_path, value, errors) if key in self.children \
+                else freeze(value)
+
+        for key in self.required:
+            if config.get(key) is None:
+                errors.append("Missing required entry '{}' in '{}'".format(key, path or 'config'))
+        for key, default in self.defaults.items():
+            if result.get(key) is None:
+                result[key] = default
+        return FrozenDict(result)
+
+    def validate_list(self, path, values, errors):
+        if self.minimum is not None and len(values) < self.minimum:
+            errors.append("'{}' needs to have at least {} entries".format(path, self.minimum))
+        result = []
+        for i, value in enumerate(values):
+            entry_path = "{}[{}]".format(path, i)
+            if self.list_type and not matches(value, self.list_type):
+                errors.append("Entries of '{}' must be {}, '{}' was {}".format(path, type_name(self.list_type),
+                                                                              entry_path, type(value).__name__))
+                continue
+            result.append(self.validate(entry_path, value, errors))
+        for key in self.unique:
+            seen = set()
+            for i, value in enumerate(result):
+                if not isinstance(value, dict) or value.get(key) is None:
+                    continue
+                if value[key] in seen:
+                    errors.append("'{}[{}].{}' must be unique, '{}' is used more than once".format(
+                        path, i, key, value[key]))
+                seen.add(value[key])
+        return tuple(result)
+
+
 class Config(object):
     config = None
 
     def __init__(self, config_path, requirements, defaults):
-        self.config = read_config(config_path, defaults)
         self.requirements = requirements
-        self.valid = self.validator[type(self.config)](self, 'Base', self.config, self.requirements)
+        self.errors = []
+        config = read_config(config_path, defaults)
+        if isinstance(config, dict):
+            self.config = Schema.compile(requirements).validate('', config, self.errors)
+        else:
+            self.errors.append("No config found in directory {}".format(config_path))
+        for error in self.errors:
+            logging.error("Config validation failed: {}".format(error))
+        self.valid = not self.errors
 
     def parse_config(self, config, requirements):
         return
 
-    def validate_and_strip_dict(self, key, config_dict, config_requirements):
-        specs = config_requirements['specs']
-        required_entries = specs.get('required_entries', {})
-        optional_entries = specs.get('optional_entries', {})
-        config_dict = strip_config(config_dict, list(required_entries.keys()) + list(optional_entries.keys()))
-
-        logging.debug("Validating dict {0} with specs: {1}".format(config_dict, specs))
-        valid = True
-        for required_key, required_type in required_entries.items():
-            if required_key in config_dict:
-                if not isinstance(config_dict[required_key], required_type):
-                    logging.error("Config validation failed: Value of \'{0}\' must be {1}, was {2}".format(required_key, required_type,
-                                                                                                           type(config_dict[
-                                                                                                                    required_key])))
-                    valid = False
-            else:
-                logging.error("Config validation failed: Missing required field \'{0}\' in \'{1}\'".format(required_key, key))
-                valid = False
-
-        for optional_key, optional_type in optional_entries.items():
-            if optional_key in config_dict and not isinstance(config_dict[optional_key], optional_type):
-                logging.error(
-                    "Config validation failed: Value of optional entry \'{0}\' must be {1}, was {2}".format(optional_key, optional_type,
-                                                                                                            type(config_dict[
-                                                                                                                     optional_key])))
-                valid = False
-
-        if 'children' in config_requirements:
-            for child_key, child_value in config_requirements['children'].items():
-                if valid and child_key in config_dict:
-                    valid = self.validator[type(config_dict[child_key])](self, child_key, config_dict[child_key], child_value)
-        return valid
-
-    def validate_list(self, key, value_list, specs):
-        logging.debug("Validating list {0} with specs: {1}".format(value_list, specs))
-        valid = True
-        if 'minimum' in specs and len(value_list) < specs['minimum']:
-            logging.error("Config validation failed: \'{0}\' needs to have at least {1} entries".format(key, specs['minimum']))
-            valid = False
-
-        for value in value_list:
-            if valid:
-                valid = self.validator[type(value)](self, key, value, specs)
-
-        return valid
-
-    validator = {dict: validate_and_strip_dict,
-                 list: validate_list}
-
     def isvalid(self):
         return self.valid
 
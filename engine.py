@@ -0,0 +1,237 @@
+from builtins import object
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import signal
+import threading
+
+from health import DeviceState
+from igrill import DeviceThread
+
+
+class ThreadEngine(object):
+    """
+    Runs every device in its own DeviceThread until SIGINT/SIGTERM. With a reloader, the config is reloaded on
+    SIGHUP and, if it has a watch_interval, whenever a config file changes.
+    """
+
+    def __init__(self, monitors, reloader=None):
+        self.initial_monitors = monitors
+        self.reloader = reloader
+        self.run_event = threading.Event()
+        self.monitors = {}
+        self.threads = {}
+        self.started = 0
+        self.wake_event = threading.Event()
+        self.stopping = False
+        self.reload_requested = False
+
+    def add_monitor(self, monitor):
+        thread = DeviceThread(self.started, None, self.run_event, monitor=monitor)
+        self.started += 1
+        self.monitors[monitor.name] = monitor
+        self.threads[monitor.name] = thread
+        thread.start()
+
+    def remove_monitor(self, name):
+        """Stops the device, waiting for it to disconnect"""
+        monitor = self.monitors.pop(name)
+        thread = self.threads.pop(name)
+        thread.stop()
+        thread.join()
+        monitor.release()
+
+    def stop(self, *args):
+        self.stopping = True
+        self.wake_event.set()
+
+    def request_reload(self, *args):
+        self.reload_requested = True
+        self.wake_event.set()
+
+    def run(self):
+        self.run_event.set()
+        for monitor in self.initial_monitors:
+            self.add_monitor(monitor)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.stop)
+        if self.reloader:
+            signal.signal(signal.SIGHUP, self.request_reload)
+        wait = self.reloader.watch_interval if self.reloader and self.reloader.watch_interval else 3600
+
+        # Sleep until signalled
+        while not self.stopping:
+            self.wake_event.wait(wait)
+            self.wake_event.clear()
+            if self.stopping:
+                break
+            if self.reload_requested or (self.reloader and self.reloader.watch_interval and self.reloader.changed()):
+                self.reload_requested = False
+                try:
+                    self.reloader.reload(self)
+                except Exception:
+                    logging.exception("Failed to reload the config")
+
+        logging.info('Signaling all device threads to finish')
+        self.run_event.clear()
+        for thread in self.threads.values():
+            thread.join()
+        logging.info('All threads finished, exiting')
+
+
+class AsyncEngine(object):
+    """
+    Drives the reads, publishes and reconnect backoff of all devices from a single asyncio event loop. The
+    blocking bluepy calls run in bounded thread pools, one for polls and one for connects, so devices waiting for
+    a connection slot or a connect timeout never hold up the polls of connected devices. Shutdown cancels every
+    device immediately instead of waiting for their sleeps to finish. Config reloads work as for the ThreadEngine,
+    running in a worker thread so stopping devices and rebuilding the sink never block the event loop.
+    """
+
+    def __init__(self, monitors, max_workers=4, reloader=None):
+        self.initial_monitors = monitors
+        self.max_workers = max_workers
+        self.reloader = reloader
+        self.executor = None
+        self.connect_executor = None
+        self.stop_event = None
+        self.loop = None
+        self.reload_lock = None
+        self.monitors = {}
+        self.tasks = {}
+
+    async def blocking(self, function, executor=None):
+        """
+        Runs function in a worker thread. The call cannot be interrupted, so when cancelled while the engine keeps
+        running (the device was removed), waits for it to finish before passing the cancellation on
+        """
+        future = asyncio.get_event_loop().run_in_executor(executor or self.executor, function)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not self.stop_event.is_set():
+                await asyncio.gather(future, return_exceptions=True)
+            raise
+
+    async def run_device(self, monitor):
+        try:
+            while True:
+                try:
+                    await self.blocking(monitor.connect, self.connect_executor)
+                    while True:
+                        await self.blocking(monitor.poll)
+                        logging.debug("Sleeping for {} seconds".format(monitor.current_interval))
+                        await asyncio.sleep(monitor.current_interval)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    await self.blocking(monitor.disconnect)
+                    delay = monitor.failed(e)
+                    if delay is None:
+                        return
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if self.stop_event.is_set():
+                # Do not wait for a connect or read that may still be blocking a worker
+                self.executor.submit(monitor.disconnect)
+            else:
+                # Removed or restarted, the call in flight has finished, so the link is closed before a new
+                # monitor of the device connects
+                await asyncio.gather(self.loop.run_in_executor(self.executor, monitor.disconnect),
+                                     return_exceptions=True)
+            # Removed (or restarted) devices are no longer reported
+            if self.monitors.get(monitor.name) is monitor:
+                monitor.set_state(DeviceState.STOPPED)
+            raise
+
+    def in_loop(self, function, *args):
+        """
+        Calls function on the event loop, waiting for its result, or for the coroutine it returns to finish, when
+        called from another thread (the reloader)
+        """
+        if threading.current_thread() is threading.main_thread():
+            result = function(*args)
+            return asyncio.ensure_future(result) if asyncio.iscoroutine(result) else result
+
+        async def call():
+            result = function(*args)
+            return await result if asyncio.iscoroutine(result) else result
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def start_monitor(self, monitor):
+        self.monitors[monitor.name] = monitor
+        self.tasks[monitor.name] = asyncio.ensure_future(self.run_device(monitor))
+
+    async def stop_monitor(self, name):
+        """Cancels the device, returning once its blocking call in flight finished and it disconnected"""
+        monitor = self.monitors.pop(name)
+        task = self.tasks.pop(name)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        monitor.release()
+
+    def add_monitor(self, monitor):
+        self.in_loop(self.start_monitor, monitor)
+
+    def remove_monitor(self, name):
+        self.in_loop(self.stop_monitor, name)
+
+    def stop(self):
+        logging.info('Signaling all devices to finish')
+        self.stop_event.set()
+
+    async def reload(self):
+        async with self.reload_lock:
+            try:
+                await self.loop.run_in_executor(None, self.reloader.reload, self)
+            except Exception:
+                logging.exception("Failed to reload the config")
+
+    def request_reload(self):
+        asyncio.ensure_future(self.reload())
+
+    async def watch(self):
+        """Reloads the config whenever a config file changes"""
+        while True:
+            await asyncio.sleep(self.reloader.watch_interval)
+            if self.reloader.changed():
+                await self.reload()
+
+    async def main(self, timeout=None):
+        self.stop_event = asyncio.Event()
+        self.reload_lock = asyncio.Lock()
+        self.loop = loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        watcher = None
+        if self.reloader:
+            loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+            if self.reloader.watch_interval:
+                watcher = asyncio.ensure_future(self.watch())
+
+        for monitor in self.initial_monitors:
+            self.add_monitor(monitor)
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.info('Run time of {} seconds reached, stopping all devices'.format(timeout))
+
+        if watcher:
+            watcher.cancel()
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, timeout=None):
+        """Runs until SIGINT/SIGTERM, or for at most timeout seconds if given"""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.connect_executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            asyncio.run(self.main(timeout))
+        finally:
+            # Blocking calls still running in the pools cannot be interrupted, but nothing waits on their results
+            self.executor.shutdown(wait=False)
+            self.connect_executor.shutdown(wait=False)
+        logging.info('All devices finished, exiting')
@@ -0,0 +1,61 @@
+from builtins import object
+import json
+import logging
+import os
+import threading
+
+
+class HandleCache(object):
+    """
+    Remembers the GATT value handles of each device, keyed by MAC address and device type, so reconnects can skip
+    service discovery. Optionally persisted to a JSON file, so the handles also survive restarts.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.handles = self.load()
+
+    @staticmethod
+    def key(address, device_type):
+        return "{}/{}".format(address.upper(), device_type)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            logging.exception("Failed to read handle cache from: {}, starting with an empty cache".format(self.path))
+            return {}
+
+    def save(self):
+        if not self.path:
+            return
+
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(self.handles, cache_file, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            logging.exception("Failed to write handle cache to: {}".format(self.path))
+
+    def get(self, address, device_type):
+        """Returns a copy of the cached {uuid: handle} map for the device, or None if not cached"""
+        with self.lock:
+            handles = self.handles.get(self.key(address, device_type))
+            return dict(handles) if handles else None
+
+    def put(self, address, device_type, handles):
+        with self.lock:
+            self.handles[self.key(address, device_type)] = dict(handles)
+            self.save()
+
+    def invalidate(self, address, device_type):
+        with self.lock:
+            if self.handles.pop(self.key(address, device_type), None) is not None:
+                logging.debug("Invalidated cached handles for {} ({})".format(address, device_type))
+                self.save()
@@ -0,0 +1,80 @@
+from builtins import object
+import logging
+import random
+import threading
+import time
+
+
+class DeviceState(object):
+    ABSENT = 'absent'
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    BACKING_OFF = 'backing_off'
+    FAILED = 'failed'
+    STOPPED = 'stopped'
+
+
+class DeviceStatusRegistry(object):
+    """
+    Keeps the connection state of every device, so it can be inspected from anywhere in the process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statuses = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """Calls listener(name, status) on every update"""
+        self.listeners.append(listener)
+
+    def update(self, name, state, error=None, retry_in=None, log=True):
+        with self.lock:
+            previous = self.statuses.get(name, {}).get('state')
+            self.statuses[name] = {'state': state,
+                                   'since': time.time() if state != previous else self.statuses[name]['since'],
+                                   'error': str(error) if error else None,
+                                   'retry_in': retry_in}
+            status = dict(self.statuses[name])
+        for listener in self.listeners:
+            listener(name, status)
+        if state != previous and log:
+            level = logging.INFO if state in (DeviceState.CONNECTED, DeviceState.FAILED) else logging.DEBUG
+            logging.log(level, "Device {} is now {}{}".format(name, state, ": {}".format(error) if error else ''))
+
+    def remove(self, name):
+        with self.lock:
+            self.statuses.pop(name, None)
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.statuses[name]) if name in self.statuses else None
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(status) for name, status in self.statuses.items()}
+
+
+# Process wide registry all devices report their state to
+device_status = DeviceStatusRegistry()
+
+
+class ReconnectPolicy(object):
+    """
+    Exponential backoff with jitter between reconnect attempts, capped at max_delay
+    """
+
+    def __init__(self, initial_delay=1, max_delay=300, multiplier=2, jitter=0.5, max_attempts=None):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait after the given (zero based) number of consecutive failures"""
+        delay = min(self.max_delay, self.initial_delay * self.multiplier ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def exhausted(self, attempt):
+        return self.max_attempts is not None and attempt >= self.max_attempts
@@ -0,0 +1,212 @@
+from builtins import object
+from builtins import range
+from array import array
+import csv
+import io
+import json
+import logging
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from sinks import Sink
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity buffer of (timestamp, value) pairs, backed by two arrays of doubles. Once full, every append
+    overwrites the oldest entry, so memory use never grows.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp, value):
+        end = (self.start + self.size) % self.capacity
+        self.timestamps[end] = timestamp
+        self.values[end] = value
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def timestamp(self, i):
+        return self.timestamps[(self.start + i) % self.capacity]
+
+    def bisect(self, timestamp):
+        """Index (oldest first) of the first entry at or after timestamp"""
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self, since=None, until=None):
+        """Returns the (timestamp, value) pairs between since and until, oldest first"""
+        first = self.bisect(since) if since is not None else 0
+        last = self.bisect(until) if until is not None else self.size
+        return [(self.timestamps[(self.start + i) % self.capacity], self.values[(self.start + i) % self.capacity])
+                for i in range(first, last)]
+
+    def downsample(self, bucket, since=None, until=None):
+        """Returns (bucket start, min, max, avg, count) for each bucket of the given number of seconds with data"""
+        buckets = []
+        for timestamp, value in self.window(since, until):
+            bucket_start = timestamp - timestamp % bucket
+            if buckets and buckets[-1][0] == bucket_start:
+                _, low, high, total, count = buckets[-1]
+                buckets[-1] = (bucket_start, min(low, value), max(high, value), total + value, count + 1)
+            else:
+                buckets.append((bucket_start, value, value, value, 1))
+        return [(start, low, high, total / count, count) for start, low, high, total, count in buckets]
+
+
+class History(object):
+    """
+    Recent readings of every device, kept in one RingBuffer per device and metric (probe1..4, battery)
+    """
+
+    def __init__(self, capacity=8640):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    @staticmethod
+    def numeric(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def append(self, device_name, metric, timestamp, value):
+        key = (device_name, metric)
+        if key not in self.buffers:
+            self.buffers[key] = RingBuffer(self.capacity)
+        self.buffers[key].append(timestamp, value)
+
+    def record(self, reading):
+        with self.lock:
+            for i, temperature in reading.temperatures.items():
+                if self.numeric(temperature):
+                    self.append(reading.device_name, "probe{}".format(i), reading.timestamp, temperature)
+            if self.numeric(reading.battery):
+                self.append(reading.device_name, 'battery', reading.timestamp, reading.battery)
+
+    def devices(self):
+        with self.lock:
+            devices = {}
+            for device_name, metric in self.buffers:
+                devices.setdefault(device_name, []).append(metric)
+            return {device_name: sorted(metrics) for device_name, metrics in devices.items()}
+
+    def query(self, device_name, metrics=None, since=None, until=None, bucket=None):
+        """
+        Returns {metric: rows} for the device, where rows are (timestamp, value) pairs, or
+        (bucket start, min, max, avg, count) tuples when downsampled into buckets of the given number of seconds
+        """
+        with self.lock:
+            result = {}
+            for (name, metric), buffer in self.buffers.items():
+                if name != device_name or (metrics and metric not in metrics):
+                    continue
+                result[metric] = buffer.downsample(bucket, since, until) if bucket else buffer.window(since, until)
+            return result
+
+
+class HistoryRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /devices                   Devices and their metrics
+    GET /history/<device>          Readings of a device. Query parameters:
+        metric=probe1              Only these metrics (may be repeated), default all
+        window=3600                Only the last number of seconds, default everything kept
+        bucket=60                  Downsample into min/max/avg buckets of this many seconds
+        format=csv                 csv or json, default json
+    """
+
+    def send(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = parse_qs(url.query)
+        try:
+            if parts == ['devices']:
+                self.send(200, 'application/json', json.dumps(self.server.history.devices()))
+            elif len(parts) == 2 and parts[0] == 'history':
+                self.send_history(parts[1], query)
+            else:
+                self.send(404, 'text/plain', 'Not found\n')
+        except ValueError as e:
+            self.send(400, 'text/plain', "{}\n".format(e))
+
+    def send_history(self, device_name, query):
+        window = float(query['window'][0]) if 'window' in query else None
+        bucket = float(query['bucket'][0]) if 'bucket' in query else None
+        if bucket is not None and bucket <= 0:
+            raise ValueError("bucket must be positive")
+        since = time.time() - window if window is not None else None
+        result = self.server.history.query(device_name, query.get('metric'), since, bucket=bucket)
+        if not result:
+            self.send(404, 'text/plain', "No history for device {}\n".format(device_name))
+            return
+
+        if query.get('format', ['json'])[0] == 'csv':
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(['timestamp', 'device', 'metric'] + (['min', 'max', 'avg', 'count'] if bucket else ['value']))
+            for metric, rows in sorted(result.items()):
+                for row in rows:
+                    writer.writerow([row[0], device_name, metric] + list(row[1:]))
+            self.send(200, 'text/csv', output.getvalue())
+        else:
+            fields = ['timestamp', 'min', 'max', 'avg', 'count'] if bucket else ['timestamp', 'value']
+            self.send(200, 'application/json',
+                      json.dumps({metric: [dict(zip(fields, row)) for row in rows] for metric, rows in result.items()}))
+
+    def log_message(self, format, *args):
+        logging.debug("History API: {}".format(format % args))
+
+
+class HistoryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, history, host='127.0.0.1', port=8090):
+        HTTPServer.__init__(self, (host, port), HistoryRequestHandler)
+        self.history = history
+
+
+class HistorySink(Sink):
+    """
+    Records every reading in a History, and serves it over HTTP while open
+    """
+
+    def __init__(self, capacity=8640, host='127.0.0.1', port=8090):
+        self.history = History(capacity)
+        self.server = HistoryServer(self.history, host, port)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name='HistoryServer')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        logging.info("Serving reading history on http://{}:{}/".format(host, port))
+
+    def publish(self, reading):
+        self.history.record(reading)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -7,6 +7,11 @@ import time
 import bluepy.btle as btle
 
 import utils
+from adaptive import AdaptiveInterval
+from health import DeviceState, ReconnectPolicy, device_status
+from metrics import metrics
+from presence import DeviceAbsent
+from scheduler import ConnectionScheduler
 
 
 class UUIDS(object):
@@ -30,60 +35,190 @@ class UUIDS(object):
     HEATING_ELEMENTS   = btle.UUID('6c91000a-58dc-41c7-943f-518b278ceaaa')
 
 
+# Characteristic names by uuid, for labelling metrics (CONFIG shares its uuid with PROBE1_TEMPERATURE)
+CHARACTERISTIC_NAMES = {str(uuid): name.lower() for name, uuid in vars(UUIDS).items()
+                        if isinstance(uuid, btle.UUID) and name != 'CONFIG'}
+
+
+# Raw value reported by a probe socket with no probe plugged in
+PROBE_UNPLUGGED_VALUE = 63536
+
+# Client characteristic configuration descriptor, written to enable notifications
+CCCD_UUID = btle.UUID(0x2902)
+# Service and characteristic declarations, which end the descriptors of a characteristic
+DECLARATION_UUIDS = (btle.UUID(0x2800), btle.UUID(0x2801), btle.UUID(0x2803))
+
+
+class DeviceUnsupported(Exception):
+    """Raised for errors that retrying cannot fix, like an unknown device type"""
+
+
+class MissingCharacteristics(DeviceUnsupported):
+    """Raised when a device lacks characteristics its type needs"""
+
+
+def decode_temperature(data):
+    """Decode the little endian temperature from a single read or notification value"""
+    data = bytearray(data)
+    return data[1] * 256 + data[0]
+
+
+class TemperatureDelegate(btle.DefaultDelegate):
+    """
+    Keeps the latest temperature notified by each subscribed probe
+    """
+
+    def __init__(self, probe_handles):
+        btle.DefaultDelegate.__init__(self)
+        self.probe_handles = probe_handles
+        self.temperatures = {}
+
+    def handleNotification(self, cHandle, data):
+        if cHandle in self.probe_handles:
+            probe_num = self.probe_handles[cHandle]
+            self.temperatures[probe_num] = decode_temperature(data)
+            logging.debug("Notification for probe {} with value {}".format(probe_num, self.temperatures[probe_num]))
+
+
 class IDevicePeripheral(btle.Peripheral):
     encryption_key = None
-    btle_lock = threading.Lock()
+    # Shared by all devices unless a scheduler is passed in
+    scheduler = ConnectionScheduler()
+    device_type = None
     has_battery = None
     has_heating_element = None
+    temperature_delegate = None
+    # Attempts per characteristic read, and seconds between them, before a read error is passed on
+    read_attempts = 3
+    read_retry_delay = 0.2
 
-    def __init__(self, address, name, num_probes, has_battery=True, has_heating_element=False):
+    def __init__(self, address, name, num_probes, has_battery=True, has_heating_element=False, notifications=False,
+                 handle_cache=None, scheduler=None, adapter=None):
         """
         Connects to the device given by address performing necessary authentication
         """
-        logging.debug("Trying to connect to the device with address {}".format(address))
-        with self.btle_lock:
-            logging.debug("Calling btle.Peripheral.__init__ with lock: {}".format(id(self.btle_lock)))
-            btle.Peripheral.__init__(self, address)
-            logging.debug("Releasing lock: {}".format(id(self.btle_lock)))
+        if scheduler is not None:
+            self.scheduler = scheduler
+        adapter = self.scheduler.assign(address, adapter)
+        logging.debug("Trying to connect to the device with address {} on adapter hci{}".format(address, adapter))
+        with self.scheduler.connecting(adapter, address), metrics.timer('igrill_connect_seconds', device=name):
+            self.connect_peripheral(address, adapter)
+        self.address = address
         self.name = name
         self.has_battery = has_battery
         self.has_heating_element = has_heating_element
+        self.num_probes = num_probes
+        self.handle_cache = handle_cache
         # iDevice devices require bonding. I don't think this will give us bonding
         # if no bonding exists, so please use bluetoothctl to create a bond first
         self.setSecurityLevel('medium')
 
-        # enumerate all characteristics so we can look up handles from uuids
-        self.characteristics = self.getCharacteristics()
-
-        # Set handle for reading battery level
-        if has_battery:
-            self.battery_char = self.characteristic(UUIDS.BATTERY_LEVEL)
-
-        # Set handle for reading main elements
-        if has_heating_element:
-            self.heating_elements = self.characteristic(UUIDS.HEATING_ELEMENTS)
+        # Use cached handles if we have them, only enumerating all characteristics if they turn out to be stale
+        self.handles = handle_cache.get(address, self.device_type) if handle_cache else None
+        if self.handles:
+            logging.debug("Using cached handles for {}".format(address))
+            cached = dict(self.handles)
+            try:
+                self.setup(notifications)
+                self.update_handle_cache(cached)
+                return
+            except (btle.BTLEGattError, MissingCharacteristics, KeyError) as e:
+                # A stale handle fails on the device, a partial cache entry misses a uuid
+                logging.info("Cached handles for {} failed ({!r}), rediscovering".format(address, e))
+                handle_cache.invalidate(address, self.device_type)
+
+        with metrics.timer('igrill_discovery_seconds', device=self.name):
+            self.handles = self.discover_handles()
+        self.setup(notifications)
+        self.update_handle_cache(None)
+
+    def update_handle_cache(self, cached):
+        """Stores the handles if they differ from the cached ones, for example by descriptors looked up since"""
+        if self.handle_cache and self.handles != cached:
+            self.handle_cache.put(self.address, self.device_type, self.handles)
+
+    def connect_peripheral(self, address, adapter):
+        btle.Peripheral.__init__(self, address, iface=adapter)
+
+    def discover_handles(self):
+        """
+        Enumerates all characteristics, returning a map of uuid to value handle
+        """
+        logging.debug("Discovering characteristics for {}".format(self.address))
+        return {str(c.uuid): c.getHandle() for c in self.getCharacteristics()}
+
+    def required_uuids(self):
+        uuids = [UUIDS.APP_CHALLENGE, UUIDS.DEVICE_CHALLENGE, UUIDS.DEVICE_RESPONSE]
+        uuids += [getattr(UUIDS, "PROBE{}_TEMPERATURE".format(probe_num)) for probe_num in range(1, self.num_probes + 1)]
+        if self.has_battery:
+            uuids.append(UUIDS.BATTERY_LEVEL)
+        if self.has_heating_element:
+            uuids.append(UUIDS.HEATING_ELEMENTS)
+        return uuids
+
+    def setup(self, notifications):
+        missing = [str(uuid) for uuid in self.required_uuids() if str(uuid) not in self.handles]
+        if missing:
+            raise MissingCharacteristics("Device {} has no characteristics {}".format(self.address, ', '.join(missing)))
+        self.characteristic_names = {handle: CHARACTERISTIC_NAMES.get(uuid, uuid) for uuid, handle in self.handles.items()}
 
         # authenticate with iDevices custom challenge/response protocol
-        if not self.authenticate():
-            raise RuntimeError('Unable to authenticate with device')
+        with metrics.timer('igrill_authenticate_seconds', device=self.name):
+            if not self.authenticate():
+                raise RuntimeError('Unable to authenticate with device')
 
-        # find characteristics for temperature
-        self.num_probes = num_probes
-        self.temp_chars = {}
+        # find handles for temperature
+        self.temp_handles = {}
 
         for probe_num in range(1, self.num_probes + 1):
             temp_char_name = "PROBE{}_TEMPERATURE".format(probe_num)
-            temp_char = self.characteristic(getattr(UUIDS, temp_char_name))
-            self.temp_chars[probe_num] = temp_char
-            logging.debug("Added probe with index {0}, name {1}, and UUID {2}".format(probe_num, temp_char_name, temp_char))
+            self.temp_handles[probe_num] = self.handle(getattr(UUIDS, temp_char_name))
+            logging.debug("Added probe with index {0}, name {1}, and handle {2}".format(probe_num, temp_char_name,
+                                                                                     self.temp_handles[probe_num]))
 
-    def characteristic(self, uuid):
+        if notifications:
+            self.subscribe_temperatures()
+
+    def handle(self, uuid):
         """
-        Returns the characteristic for a given uuid.
+        Returns the value handle for a given uuid.
         """
-        for c in self.characteristics:
-            if c.uuid == uuid:
-                return c
+        return self.handles[str(uuid)]
+
+    def is_connected(self):
+        """Returns if the link to the device is still up"""
+        try:
+            return self.getState() == 'conn'
+        except btle.BTLEException:
+            return False
+
+    def read_handle(self, handle):
+        """
+        Reads a characteristic, retrying transient errors on the live connection. Disconnects, and errors once the
+        link is down, are raised right away so the device reconnects
+        """
+        for attempt in range(1, self.read_attempts + 1):
+            try:
+                return self.read_once(handle)
+            except btle.BTLEDisconnectError:
+                raise
+            except btle.BTLEException as e:
+                if attempt == self.read_attempts or not self.is_connected():
+                    raise
+                characteristic = self.characteristic_names.get(handle, handle)
+                logging.debug("Read of {} from {} failed ({}), retrying".format(characteristic, self.name, e))
+                metrics.inc('igrill_read_retries_total', device=self.name, characteristic=characteristic)
+                time.sleep(self.read_retry_delay)
+
+    def read_once(self, handle):
+        if not metrics.enabled:
+            return self.readCharacteristic(handle)
+        with metrics.timer('igrill_read_seconds', device=self.name,
+                           characteristic=self.characteristic_names.get(handle, handle)):
+            return self.readCharacteristic(handle)
+
+    def write_handle(self, handle, value):
+        self.writeCharacteristic(handle, value, True)
 
     def authenticate(self):
         """
@@ -96,7 +231,7 @@ class IDevicePeripheral(btle.Peripheral):
         # send app challenge (16 bytes) (must be wrapped in a bytearray)
         challenge = bytes(b'\0' * 16)
         logging.debug("Sending key of all 0's")
-        self.characteristic(UUIDS.APP_CHALLENGE).write(challenge, True)
+        self.write_handle(self.handle(UUIDS.APP_CHALLENGE), challenge)
 
         """
         Normally we'd have to perform some crypto operations:
@@ -110,27 +245,93 @@ class IDevicePeripheral(btle.Peripheral):
         But wait!  Our first 8 bytes are already 0.  That means we don't need the key.
         We just hand back the same encrypted value we get and we're good.
         """
-        encrypted_device_challenge = self.characteristic(UUIDS.DEVICE_CHALLENGE).read()
-        self.characteristic(UUIDS.DEVICE_RESPONSE).write(encrypted_device_challenge, True)
+        encrypted_device_challenge = self.read_handle(self.handle(UUIDS.DEVICE_CHALLENGE))
+        self.write_handle(self.handle(UUIDS.DEVICE_RESPONSE), encrypted_device_challenge)
 
         logging.debug("Authenticated")
 
         return True
 
+    def subscribe_temperatures(self):
+        """
+        Enables notifications on all probe temperature characteristics, so new temperatures are pushed by the
+        device instead of read on every cycle
+        """
+        self.temperature_delegate = TemperatureDelegate({h: n for n, h in self.temp_handles.items()})
+        self.setDelegate(self.temperature_delegate)
+
+        for probe_num, temp_handle in list(self.temp_handles.items()):
+            # Read once, so we have a value until the first notification arrives
+            self.temperature_delegate.temperatures[probe_num] = decode_temperature(self.read_handle(temp_handle))
+            self.write_handle(self.cccd_handle(temp_handle), b'\x01\x00')
+            logging.debug("Subscribed to temperature notifications for probe {}".format(probe_num))
+
+    def cccd_handle(self, value_handle):
+        """
+        Returns the handle of the client characteristic configuration descriptor of a characteristic. Looked up
+        once, and kept with the value handles, so it is cached too
+        """
+        key = "{}/cccd".format(value_handle)
+        if key not in self.handles:
+            self.handles[key] = self.find_cccd(value_handle)
+        return self.handles[key]
+
+    def find_cccd(self, value_handle):
+        for descriptor in self.getDescriptors(value_handle + 1):
+            if descriptor.uuid in DECLARATION_UUIDS:
+                break
+            if descriptor.uuid == CCCD_UUID:
+                return descriptor.handle
+        # Not listed, it usually directly follows the value
+        return value_handle + 1
+
+    def wait(self, seconds, running=None):
+        """
+        Waits for the given number of seconds, handling temperature notifications in the meantime if subscribed.
+        With running given, waits in slices of at most a second and returns early once running() is false
+        """
+        slice_seconds = 1 if running else seconds
+        deadline = time.time() + seconds
+        remaining = seconds
+        while remaining > 0 and (running is None or running()):
+            if self.temperature_delegate:
+                self.waitForNotifications(min(slice_seconds, remaining))
+            else:
+                time.sleep(min(slice_seconds, remaining))
+            remaining = deadline - time.time()
+
     def read_battery(self):
-        return float(bytearray(self.battery_char.read())[0]) if self.has_battery else None
+        return float(bytearray(self.read_handle(self.handle(UUIDS.BATTERY_LEVEL)))[0]) if self.has_battery else None
 
     def read_heating_elements(self):
-        return bytearray(self.heating_elements.read()) if self.has_heating_element else None
+        return bytearray(self.read_handle(self.handle(UUIDS.HEATING_ELEMENTS))) if self.has_heating_element else None
+
+    def read_thresholds(self):
+        """
+        Returns the temperature threshold set on the device for each probe that has one
+        """
+        thresholds = {}
+        for probe_num in range(1, self.num_probes + 1):
+            threshold_char_name = "PROBE{}_THRESHOLD".format(probe_num)
+            threshold = decode_temperature(self.read_handle(self.handle(getattr(UUIDS, threshold_char_name))))
+            if threshold not in (0, PROBE_UNPLUGGED_VALUE):
+                thresholds[probe_num] = float(threshold)
+        return thresholds
 
     def read_temperature(self, publish_empty, missing_value):
         empty = False if not publish_empty else missing_value
         temps = {1: False, 2: False, 3: False, 4: False}
 
-        for probe_num, temp_char in list(self.temp_chars.items()):
-            temp = bytearray(temp_char.read())[1] * 256
-            temp += bytearray(temp_char.read())[0]
-            temps[probe_num] = float(temp) if float(temp) != 63536.0 else empty
+        if self.temperature_delegate:
+            # Handle notifications already sent by the device, without blocking
+            while self.waitForNotifications(0):
+                pass
+            raw_temps = self.temperature_delegate.temperatures
+        else:
+            raw_temps = {probe_num: decode_temperature(self.read_handle(temp_handle)) for probe_num, temp_handle in self.temp_handles.items()}
+
+        for probe_num, temp in raw_temps.items():
+            temps[probe_num] = float(temp) if temp != PROBE_UNPLUGGED_VALUE else empty
 
         return temps
 
@@ -140,9 +341,11 @@ class IGrillMiniPeripheral(IDevicePeripheral):
     Specialization of iDevice peripheral for the iGrill Mini
     """
 
-    def __init__(self, address, name='igrill_mini', num_probes=1):
+    device_type = 'igrill_mini'
+
+    def __init__(self, address, name='igrill_mini', num_probes=1, **kwargs):
         logging.debug("Created new device with name {}".format(name))
-        IDevicePeripheral.__init__(self, address, name, num_probes)
+        IDevicePeripheral.__init__(self, address, name, num_probes, **kwargs)
 
 
 class IGrillV2Peripheral(IDevicePeripheral):
@@ -150,9 +353,11 @@ class IGrillV2Peripheral(IDevicePeripheral):
     Specialization of iDevice peripheral for the iGrill v2
     """
 
-    def __init__(self, address, name='igrill_v2', num_probes=4):
+    device_type = 'igrill_v2'
+
+    def __init__(self, address, name='igrill_v2', num_probes=4, **kwargs):
         logging.debug("Created new device with name {}".format(name))
-        IDevicePeripheral.__init__(self, address, name, num_probes)
+        IDevicePeripheral.__init__(self, address, name, num_probes, **kwargs)
 
 
 class IGrillV3Peripheral(IDevicePeripheral):
@@ -160,9 +365,11 @@ class IGrillV3Peripheral(IDevicePeripheral):
     Specialization of iDevice peripheral for the iGrill v3
     """
 
-    def __init__(self, address, name='igrill_v3', num_probes=4):
+    device_type = 'igrill_v3'
+
+    def __init__(self, address, name='igrill_v3', num_probes=4, **kwargs):
         logging.debug("Created new device with name {}".format(name))
-        IDevicePeripheral.__init__(self, address, name, num_probes)
+        IDevicePeripheral.__init__(self, address, name, num_probes, **kwargs)
 
 
 class Pulse2000Peripheral(IDevicePeripheral):
@@ -170,57 +377,275 @@ class Pulse2000Peripheral(IDevicePeripheral):
     Specialization of iDevice peripheral for the Weber Pulse 2000
     """
 
-    def __init__(self, address, name='pulse_2000', num_probes=4):
+    device_type = 'pulse_2000'
+
+    def __init__(self, address, name='pulse_2000', num_probes=4, **kwargs):
         logging.debug("Created new device with name {}".format(name))
-        IDevicePeripheral.__init__(self, address, name, num_probes, has_heating_element=True)
+        IDevicePeripheral.__init__(self, address, name, num_probes, has_heating_element=True, **kwargs)
 
 
-class DeviceThread(threading.Thread):
+class DeviceMonitor(object):
+    """
+    Connects to a single device, reads it and publishes the readings. Holds no thread of its own, so it can be
+    driven by a DeviceThread or by the asyncio engine.
+    """
+
     device_types = {'igrill_mini': IGrillMiniPeripheral,
                     'igrill_v2': IGrillV2Peripheral,
                     'igrill_v3': IGrillV3Peripheral,
                     'pulse_2000': Pulse2000Peripheral}
 
-    def __init__(self, thread_id,
-                 mqtt_config,
-                 run_event,
+    # Errors that will not go away by retrying (unknown device type, missing characteristics, broken adapter)
+    fatal_errors = (DeviceUnsupported, btle.BTLEManagementError)
+
+    # Seconds between reads of the probe thresholds set on the device, when used for the adaptive interval
+    threshold_refresh_interval = 300
+
+    # Polls in a row that may be skipped because the temperatures could not be read, while the link is still up,
+    # before reconnecting
+    max_skipped_polls = 3
+
+    # Seconds between checks whether an absent device started advertising
+    absent_check_interval = 1
+
+    def __init__(self, sink,
                  name,
                  address,
                  type,
                  topic,
                  interval,
                  publish_missing_probes=False,
-                 missing_probe_value="missing"):
-
-        threading.Thread.__init__(self)
-        self.threadID = thread_id
+                 missing_probe_value="missing",
+                 notifications=False,
+                 adapter=None,
+                 handle_cache=None,
+                 scheduler=None,
+                 reconnect_policy=None,
+                 simulation=None,
+                 adaptive_interval=None,
+                 deadband=None,
+                 presence=None):
+        # deadband is applied by the sink, see utils.create_sink
         self.name = name
         self.address = address
         self.type = type
-        self.mqtt_client = utils.mqtt_init(mqtt_config)
+        self.sink = sink
+        self.topic = topic
+        self.interval = interval
+        self.publish_missing_probes = publish_missing_probes
+        self.missing_probe_value = missing_probe_value
+        self.notifications = notifications
+        self.adapter = adapter
+        self.handle_cache = handle_cache
+        self.scheduler = scheduler
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self.simulation = simulation
+        self.presence = presence
+        self.adaptive_interval = None
+        self.adaptive_interval_config = adaptive_interval
+        self.read_device_thresholds = False
+        self.device_thresholds = {}
+        self.thresholds_read_at = 0
+        if adaptive_interval:
+            self.configure_adaptive_interval(**adaptive_interval)
+        self.failures = 0
+        self.skipped_polls = 0
+        self.polling_since = None
+        self.device = None
+        self.state = None
+
+    def configure_adaptive_interval(self, min_interval, max_interval, rate=1.0, margin=5, thresholds=None,
+                                    read_thresholds=False):
+        # Thresholds are configured per 'probeN', or per probe number
+        thresholds = {int(str(probe).replace('probe', '')): value for probe, value in (thresholds or {}).items()}
+        self.adaptive_interval = AdaptiveInterval(min_interval, max_interval, rate, margin, thresholds,
+                                                  initial_interval=self.interval)
+        self.read_device_thresholds = read_thresholds
+
+    def reconfigure(self, topic, interval, publish_missing_probes=False, missing_probe_value="missing",
+                    adaptive_interval=None):
+        """Applies changed settings to a running device, without reconnecting"""
         self.topic = topic
         self.interval = interval
-        self.run_event = run_event
         self.publish_missing_probes = publish_missing_probes
         self.missing_probe_value = missing_probe_value
+        if adaptive_interval != self.adaptive_interval_config:
+            self.adaptive_interval = None
+            self.read_device_thresholds = False
+            self.adaptive_interval_config = adaptive_interval
+            if adaptive_interval:
+                self.configure_adaptive_interval(**adaptive_interval)
+        logging.info("Device {} reconfigured".format(self.name))
+
+    @property
+    def current_interval(self):
+        """Seconds to wait before the next poll"""
+        return self.adaptive_interval.current if self.adaptive_interval else self.interval
+
+    def set_state(self, state, error=None, retry_in=None):
+        self.state = state
+        device_status.update(self.name, state, error, retry_in)
+
+    def device_type(self):
+        """The type to connect as, detected from the advertisement for 'auto' devices"""
+        if self.type != 'auto':
+            return self.type
+        if self.presence is None:
+            raise DeviceUnsupported("Device {} has type 'auto', which needs presence to be configured".format(
+                self.name))
+        return self.presence.device_type(self.address)
+
+    def connect(self):
+        if self.presence is not None and not self.presence.is_present(self.address):
+            raise DeviceAbsent("Device {} is not advertising".format(self.name))
+        device_type = self.device_type()
+        if device_type not in self.device_types:
+            raise DeviceUnsupported("Device {} has unknown type '{}'".format(self.name, device_type))
+        self.set_state(DeviceState.CONNECTING)
+        metrics.inc('igrill_connects_total', device=self.name)
+        logging.debug("Device {} (re)started, trying to connect to iGrill with address: {}".format(self.name, self.address))
+        self.device = self.device_types[device_type](self.address, self.name, notifications=self.notifications,
+                                                   handle_cache=self.handle_cache, scheduler=self.scheduler,
+                                                   adapter=self.adapter, **(self.simulation or {}))
+        self.sink.connect()
+        self.set_state(DeviceState.CONNECTED)
+        self.skipped_polls = 0
+
+    def read_optional(self, description, read):
+        """
+        Returns the result of read, or None if it failed while the link is still up, so a reading that is nice to
+        have does not cost the temperatures or a reconnect
+        """
+        try:
+            return read()
+        except btle.BTLEException as e:
+            if not self.device.is_connected():
+                raise
+            logging.warning("Failed to read {} from {}: {}".format(description, self.name, e))
+            return None
+
+    def poll(self):
+        # Tracked so a poll that hangs in bluepy (a wedged bluepy-helper) can be told apart from a slow one
+        self.polling_since = time.time()
+        try:
+            self.read_and_publish()
+        finally:
+            self.polling_since = None
+
+    def read_and_publish(self):
+        try:
+            temperature = self.device.read_temperature(self.publish_missing_probes, self.missing_probe_value)
+        except btle.BTLEException as e:
+            if self.skipped_polls >= self.max_skipped_polls or not self.device.is_connected():
+                raise
+            self.skipped_polls += 1
+            logging.warning("Failed to read temperatures from {}, skipping this poll: {}".format(self.name, e))
+            return
+        self.skipped_polls = 0
+        battery = self.read_optional('battery level', self.device.read_battery)
+        heating_element = self.read_optional('heating elements', self.device.read_heating_elements)
+        with metrics.timer('igrill_publish_seconds', device=self.name):
+            utils.publish(temperature, battery, heating_element, self.sink, self.topic, self.device.name,
+                          self.device.device_type)
+        logging.debug("Published temp: {} and battery: {} to topic {}/{}".format(temperature, battery, self.topic, self.device.name))
+        # Only a device that can be read counts as recovered, not one that connects and then fails right away
+        self.failures = 0
+
+        if self.adaptive_interval:
+            now = time.time()
+            # Thresholds rarely change, so only read them every few minutes
+            if self.read_device_thresholds and now - self.thresholds_read_at > self.threshold_refresh_interval:
+                thresholds = self.read_optional('thresholds', self.device.read_thresholds)
+                # Keep the previous thresholds until they can be read again
+                if thresholds is not None:
+                    self.device_thresholds = thresholds
+                self.thresholds_read_at = now
+            self.adaptive_interval.update(now, temperature, self.device_thresholds)
+
+    def disconnect(self):
+        if self.device is not None:
+            try:
+                self.device.disconnect()
+            except Exception as e:
+                logging.debug("Failed to disconnect from {}: {}".format(self.name, e))
+            self.device = None
+
+    def release(self):
+        """Frees the adapter assignment of a removed device, so it no longer counts towards the adapter's load"""
+        (self.scheduler or IDevicePeripheral.scheduler).release(self.address)
+
+    def failed(self, error):
+        """
+        Handles an error raised while connecting or polling. Returns the number of seconds to wait before
+        reconnecting, or None if the device should not be retried
+        """
+        if isinstance(error, DeviceAbsent):
+            # Not a failure, check again shortly so the device connects soon after it is switched on
+            self.set_state(DeviceState.ABSENT)
+            return self.absent_check_interval
+
+        metrics.inc('igrill_failures_total', device=self.name, error=type(error).__name__)
+        if isinstance(error, self.fatal_errors):
+            logging.error("Device {} failed, not retrying".format(self.name), exc_info=error)
+            self.set_state(DeviceState.FAILED, error)
+            return None
+
+        self.failures += 1
+        if self.reconnect_policy.exhausted(self.failures):
+            logging.error("Device {} gave up after {} attempts: {}".format(self.name, self.failures, error))
+            self.set_state(DeviceState.FAILED, error)
+            return None
+
+        delay = self.reconnect_policy.delay(self.failures - 1)
+        logging.debug(error)
+        logging.debug("Sleeping for {:.1f} seconds before retrying".format(delay))
+        self.set_state(DeviceState.BACKING_OFF, error, delay)
+        return delay
+
+
+class DeviceThread(threading.Thread):
+    """
+    Runs a DeviceMonitor in its own thread until run_event is cleared, or the thread is stopped
+    """
+
+    def __init__(self, thread_id, sink, run_event, monitor=None, **device_config):
+        threading.Thread.__init__(self)
+        self.threadID = thread_id
+        self.monitor = monitor or DeviceMonitor(sink, **device_config)
+        self.name = self.monitor.name
+        self.run_event = run_event
+        self.stop_event = threading.Event()
+
+    def running(self):
+        return self.run_event.is_set() and not self.stop_event.is_set()
+
+    def stop(self):
+        """Stops only this device"""
+        self.stop_event.set()
+
+    def sleep(self, seconds):
+        """Sleeps for the given number of seconds, returning early when the thread is signalled to stop"""
+        deadline = time.time() + seconds
+        remaining = seconds
+        while self.running() and remaining > 0:
+            time.sleep(min(1, remaining))
+            remaining = deadline - time.time()
 
     def run(self):
-        while self.run_event.is_set():
+        while self.running():
             try:
-                logging.debug("Device thread {} (re)started, trying to connect to iGrill with address: {}".format(self.name, self.address))
-                device = self.device_types[self.type](self.address, self.name)
-                self.mqtt_client.reconnect()
-                while True:
-                    temperature = device.read_temperature(self.publish_missing_probes, self.missing_probe_value)
-                    battery = device.read_battery()
-                    heating_element = device.read_heating_elements()
-                    utils.publish(temperature, battery, heating_element, self.mqtt_client, self.topic, device.name)
-                    logging.debug("Published temp: {} and battery: {} to topic {}/{}".format(temperature, battery, self.topic, device.name))
-                    logging.debug("Sleeping for {} seconds".format(self.interval))
-                    time.sleep(self.interval)
+                self.monitor.connect()
+                while self.running():
+                    self.monitor.poll()
+                    logging.debug("Sleeping for {} seconds".format(self.monitor.current_interval))
+                    self.monitor.device.wait(self.monitor.current_interval, self.running)
             except Exception as e:
-                logging.debug(e)
-                logging.debug("Sleeping for {} seconds before retrying".format(self.interval))
-                time.sleep(self.interval)
-
+                delay = self.monitor.failed(e)
+                if delay is None:
+                    return
+                self.sleep(delay)
+            finally:
+                self.monitor.disconnect()
+
+        self.monitor.set_state(DeviceState.STOPPED)
         logging.debug('Thread exiting')
@@ -0,0 +1,238 @@
+from builtins import object
+from builtins import range
+from collections import deque
+import base64
+from gzip import compress
+import http.client
+import logging
+import re
+import socket
+import threading
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from metrics import metrics
+from sinks import Sink, SinkError
+
+# Timestamp multiplier per line protocol precision
+PRECISIONS = {'s': 1, 'ms': 1000, 'us': 1000000, 'ns': 1000000000}
+
+TAG_ESCAPE = re.compile(r'([,= ])')
+MEASUREMENT_ESCAPE = re.compile(r'([, ])')
+
+
+def escape_tag(value):
+    return TAG_ESCAPE.sub(r'\\\1', str(value))
+
+
+def numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class LineEncoder(object):
+    """
+    Encodes readings into InfluxDB line protocol: one line per probe, tagged with the device name, type and probe
+    number, and one line for the battery level and heating elements of the device. Missing probes are left out.
+    The type is the one of the connected peripheral, so devices configured as 'auto' are tagged with their real type.
+    """
+
+    def __init__(self, measurement='igrill', precision='ms'):
+        self.measurement = MEASUREMENT_ESCAPE.sub(r'\\\1', measurement)
+        self.multiplier = PRECISIONS[precision]
+
+    def tags(self, reading):
+        tags = "{},device={}".format(self.measurement, escape_tag(reading.device_name))
+        if reading.device_type:
+            tags += ",type={}".format(escape_tag(reading.device_type))
+        return tags
+
+    def encode(self, reading):
+        tags = self.tags(reading)
+        timestamp = int(reading.timestamp * self.multiplier)
+        lines = ["{},probe={} temperature={!r} {}".format(tags, probe_num, float(temperature), timestamp)
+                 for probe_num, temperature in sorted(reading.temperatures.items()) if numeric(temperature)]
+        fields = []
+        if numeric(reading.battery):
+            fields.append("battery={!r}".format(float(reading.battery)))
+        if reading.heating_element:
+            fields.append('heating_element="{}"'.format(bytes(reading.heating_element).hex()))
+        if fields:
+            lines.append("{} {} {}".format(tags, ','.join(fields), timestamp))
+        return lines
+
+
+class HttpTransport(object):
+    """
+    Writes batches to the InfluxDB HTTP write endpoint over a single keep-alive connection, gzipped unless
+    disabled. Works with the 1.x (/write?db=...) and 2.x (/api/v2/write?org=...&bucket=...) endpoints.
+    """
+
+    def __init__(self, url, precision, token=None, username=None, password=None, gzip=True, timeout=10):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        query.setdefault('precision', [precision])
+        self.path = "{}?{}".format(parsed.path or '/write', urlencode(query, doseq=True))
+        self.connection_type = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self.gzip = gzip
+        self.headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if gzip:
+            self.headers['Content-Encoding'] = 'gzip'
+        if token:
+            self.headers['Authorization'] = "Token {}".format(token)
+        elif username:
+            credentials = "{}:{}".format(username, password or '').encode('utf-8')
+            self.headers['Authorization'] = "Basic {}".format(base64.b64encode(credentials).decode('ascii'))
+        self.connection = None
+
+    def write(self, payload):
+        if self.gzip:
+            payload = compress(payload, compresslevel=5)
+        if self.connection is None:
+            self.connection = self.connection_type(self.host, timeout=self.timeout)
+        try:
+            self.connection.request('POST', self.path, payload, self.headers)
+            response = self.connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            # The server may have closed the idle connection, the next write opens a new one
+            self.close()
+            raise
+        if response.status >= 300:
+            raise SinkError("InfluxDB write failed with status {}: {}".format(
+                response.status, body.decode('utf-8', 'replace')[:200]))
+        return len(payload)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class UdpTransport(object):
+    """
+    Sends batches to an InfluxDB UDP listener, split into datagrams of at most max_datagram_size bytes
+    """
+
+    max_datagram_size = 1400
+
+    def __init__(self, url, **kwargs):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname, parsed.port or 8089)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, payload):
+        datagram = b''
+        for line in payload.splitlines(True):
+            if datagram and len(datagram) + len(line) > self.max_datagram_size:
+                self.socket.sendto(datagram, self.address)
+                datagram = b''
+            datagram += line
+        if datagram:
+            self.socket.sendto(datagram, self.address)
+        return len(payload)
+
+    def close(self):
+        self.socket.close()
+
+
+class FileTransport(object):
+    """
+    Appends batches to a local file, for example to be picked up by Telegraf
+    """
+
+    def __init__(self, url, **kwargs):
+        self.path = urlparse(url).path
+        self.file = open(self.path, 'ab')
+
+    def write(self, payload):
+        self.file.write(payload)
+        self.file.flush()
+        return len(payload)
+
+    def close(self):
+        self.file.close()
+
+
+TRANSPORTS = {'http': HttpTransport, 'https': HttpTransport, 'udp': UdpTransport, 'file': FileTransport}
+
+
+class InfluxSink(Sink):
+    """
+    Publishes readings to InfluxDB in line protocol
+
+    Lines are queued and written by a background thread, in batches of up to batch_size lines, at least every
+    flush_interval seconds. The url selects the transport: http(s)://host:port/write?db=..., udp://host:port or
+    file:///path. Failed batches stay queued and are retried on the next flush.
+    """
+
+    def __init__(self, url, measurement='igrill', precision='ms', batch_size=5000, flush_interval=10,
+                 max_queue_size=100000, gzip=True, token=None, username=None, password=None, timeout=10):
+        scheme = urlparse(url).scheme
+        if scheme not in TRANSPORTS:
+            raise ValueError("Unknown InfluxDB url scheme: {}".format(scheme))
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown InfluxDB precision: {}".format(precision))
+        self.transport = TRANSPORTS[scheme](url, precision=precision, token=token, username=username,
+                                            password=password, gzip=gzip, timeout=timeout)
+        self.encoder = LineEncoder(measurement, precision)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = deque(maxlen=max_queue_size)
+        self.condition = threading.Condition()
+        # Only the flush thread uses the transport, close() waits for it first
+        self.running = True
+        self.flush_thread = threading.Thread(target=self.run, name='InfluxFlush')
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def publish(self, reading):
+        lines = self.encoder.encode(reading)
+        with self.condition:
+            dropped = len(self.queue) + len(lines) - self.queue.maxlen
+            if dropped > 0:
+                metrics.inc('igrill_influx_dropped_lines_total', dropped)
+            self.queue.extend(lines)
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify()
+
+    def next_batch(self):
+        return [self.queue.popleft() for _ in range(min(len(self.queue), self.batch_size))]
+
+    def flush(self):
+        """
+        Write everything currently queued. A failed batch is put back at the front of the queue and False returned
+        """
+        while True:
+            with self.condition:
+                batch = self.next_batch()
+            if not batch:
+                return True
+            try:
+                with metrics.timer('igrill_influx_write_seconds'):
+                    size = self.transport.write(('\n'.join(batch) + '\n').encode('utf-8'))
+                logging.debug("Wrote {} lines ({} bytes) to InfluxDB".format(len(batch), size))
+            except Exception as e:
+                metrics.inc('igrill_influx_write_failures_total')
+                logging.warning("Failed to write {} lines to InfluxDB, will retry: {}".format(len(batch), e))
+                with self.condition:
+                    self.queue.extendleft(reversed(batch))
+                return False
+
+    def run(self):
+        failed = False
+        while self.running:
+            with self.condition:
+                # After a failure, wait even if a full batch is queued, instead of retrying right away
+                if failed or len(self.queue) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            failed = not self.flush()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.flush_thread.join()
+        if not self.flush():
+            logging.warning("Dropping {} lines that could not be written to InfluxDB".format(len(self.queue)))
+        self.transport.close()
@@ -0,0 +1,153 @@
+from builtins import object
+from bisect import bisect_left
+import logging
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and latency histograms, labelled per device (or adapter, sink, ...). Disabled until enable()
+    is called, in which case recording a metric returns right away and timers are a shared no-op.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def enable(self):
+        self.enabled = True
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                # Count per bucket (the last one being +Inf), sum, count
+                self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram = self.histograms[key]
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, name, **labels):
+        """Context manager observing how long its block took"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name, labels)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                              for k, v in labels) + '}'
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for metric_type, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(set(name for name, _ in values)):
+                    lines.append("# TYPE {} {}".format(name, metric_type))
+                    for (metric_name, labels), value in sorted(values.items()):
+                        if metric_name == name:
+                            lines.append("{}{} {}".format(name, self.format_labels(labels), value))
+
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append("# TYPE {} histogram".format(name))
+                for (metric_name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(BUCKETS + ('+Inf',), buckets):
+                        cumulative += bucket_count
+                        lines.append("{}_bucket{} {}".format(name, self.format_labels(labels, (('le', bound),)),
+                                                             cumulative))
+                    lines.append("{}_sum{} {}".format(name, self.format_labels(labels), total))
+                    lines.append("{}_count{} {}".format(name, self.format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+# Process wide registry, all instrumentation records to this
+metrics = MetricsRegistry()
+
+
+def dump_periodically(path, interval):
+    """Writes all metrics to the given file every interval seconds"""
+    while True:
+        time.sleep(interval)
+        tmp_path = "{}.tmp".format(path)
+        try:
+            with open(tmp_path, 'w') as dump_file:
+                dump_file.write(metrics.render())
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            logging.exception("Failed to dump metrics to {}".format(path))
+
+
+def start(host='127.0.0.1', port=None, dump_path=None, dump_interval=60):
+    """Enables metrics, serving them on http://host:port/metrics and/or dumping them to dump_path"""
+    metrics.enable()
+    if port:
+        # Only imported when metrics are served, http.server takes a while to import
+        from metricsserver import serve
+        serve(host, port)
+    if dump_path:
+        dump_thread = threading.Thread(target=dump_periodically, args=(dump_path, dump_interval), name='MetricsDump')
+        dump_thread.daemon = True
+        dump_thread.start()
+        logging.info("Dumping metrics to {} every {} seconds".format(dump_path, dump_interval))
@@ -0,0 +1,37 @@
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from metrics import metrics
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics endpoint: {}".format(format % args))
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(host, port):
+    """Serves all metrics on http://host:port/metrics from a background thread"""
+    server = MetricsServer((host, port), MetricsRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+    server_thread.daemon = True
+    server_thread.start()
+    logging.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+    return server
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
-import logging
-import threading
-import time
 
-from config import Config
-from utils import log_setup, mqtt_init, get_device_threads, config_requirements, config_defaults
+from config import Config, strip_config
+from handlecache import HandleCache
+import metrics
+from health import ReconnectPolicy
+from scheduler import ConnectionScheduler
+from reload import ConfigReloader, ReloadableSink
+from utils import log_setup, create_presence, get_device_monitors, config_requirements, config_defaults
 
 
 def main():
@@ -20,6 +22,21 @@ def main():
                         help='Set log destination (file), default: \'\' (stdout)')
     parser.add_argument('--configtest', help='Parse config only',
                         action="store_true")
+    parser.add_argument('-e', '--engine', action='store', dest='engine', default='threads',
+                        choices=['threads', 'asyncio', 'processes'],
+                        help='Run each device in its own thread, all devices from one asyncio event loop, or shard '
+                             'the devices across worker processes, default: \'threads\'')
+    parser.add_argument('-w', '--workers', action='store', dest='workers', default=4, type=int,
+                        help='Number of threads running blocking bluetooth polls, and as many for connects, for the asyncio '
+                             'engine, default: 4')
+    parser.add_argument('--shards', action='store', dest='shards', default=None, type=int,
+                        help='Number of worker processes for the processes engine, default: number of CPUs')
+    parser.add_argument('--shard-by', action='store', dest='shard_by', default='count', choices=['count', 'adapter'],
+                        help='Spread devices evenly across --shards processes, or run one process per bluetooth '
+                             'adapter, default: \'count\'')
+    parser.add_argument('--watch', action='store', dest='watch_interval', default=None, type=int,
+                        help='Reload the config when its files change, checking every this many seconds. '
+                             'The config is always reloaded on SIGHUP')
     options = parser.parse_args()
 
     # Setup logging
@@ -28,31 +45,48 @@ def main():
     config = Config(options.config_directory, config_requirements, config_defaults)
 
     if options.configtest:
-        exit(config.isvalid())
+        exit(0 if config.isvalid() else 1)
 
     if not config.isvalid():
         raise ValueError("Config found in directory {0} is not valid".format(options.config_directory))
 
-    run_event = threading.Event()
-    run_event.set()
-    # Get device threads
-    devices = get_device_threads(config.get_config('devices'), config.get_config('mqtt'), run_event)
-
-    for device in devices:
-        device.start()
+    if 'metrics' in config.get_config():
+        metrics.start(**strip_config(config.get_config()['metrics'] or {}, ['host', 'port', 'dump_path',
+                                                                            'dump_interval']))
 
+    sink = ReloadableSink(config.get_config())
     try:
-        while True:
-            time.sleep(.1)
-    except KeyboardInterrupt:
-        logging.info('Signaling all device threads to finish')
-
-        run_event.clear()
-        for device in devices:
-            device.join()
-
-        logging.info('All threads finished, exiting')
+        if options.engine == 'processes':
+            # Devices run in worker processes, this process only publishes their readings
+            from sharding import ProcessEngine, ShardedDevice
+            reloader = ConfigReloader(options.config_directory, config.get_config(), sink, ShardedDevice,
+                                      options.watch_interval)
+            ProcessEngine(config.get_config(), sink, options.shards, options.shard_by, reloader, options.log_level,
+                          options.log_destination).run()
+            return
 
+        handle_cache = HandleCache(config.get_config().get('handle_cache'))
+        presence = create_presence(config.get_config(), config.get_config('devices'))
+        scheduler = ConnectionScheduler(presence=presence, **strip_config(config.get_config().get('bluetooth') or {},
+                                                                          ['adapters', 'max_concurrent_connections']))
+        if presence is not None:
+            presence.start(scheduler)
+        reconnect_policy = ReconnectPolicy(**strip_config(config.get_config().get('reconnect') or {},
+                                                          ['initial_delay', 'max_delay', 'max_attempts']))
+        monitors = get_device_monitors(config.get_config('devices'), sink, handle_cache, scheduler, reconnect_policy,
+                                       presence)
+        reloader = ConfigReloader(options.config_directory, config.get_config(), sink,
+                                  lambda d: get_device_monitors([d], sink, handle_cache, scheduler, reconnect_policy,
+                                                                presence)[0],
+                                  options.watch_interval)
+        # The engines import igrill, and with that bluepy, so only once the config is known to be valid
+        from engine import AsyncEngine, ThreadEngine
+        if options.engine == 'asyncio':
+            AsyncEngine(monitors, options.workers, reloader).run()
+        else:
+            ThreadEngine(monitors, reloader).run()
+    finally:
+        sink.close()
 
 if __name__ == '__main__':
     main()
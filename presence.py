@@ -0,0 +1,170 @@
+from builtins import object
+from contextlib import nullcontext
+import logging
+import re
+import threading
+import time
+
+import bluepy.btle as btle
+
+# Advertised service uuids of the iDevices thermometers, for detecting the type of 'auto' devices
+ADVERTISED_SERVICES = {'63c70000-4a82-4261-95ff-92cf32477861': 'igrill_mini',
+                       'a5c50000-f186-4bd6-97f2-7ebacba0d708': 'igrill_v2',
+                       '6e910000-58dc-41c7-943f-518b278ceaaa': 'igrill_v3',
+                       '6c910000-58dc-41c7-943f-518b278ceaaa': 'pulse_2000'}
+
+# Patterns matched against the advertised name when no known service is advertised, first match wins
+ADVERTISED_NAMES = [(re.compile(r'igrill.?mini', re.IGNORECASE), 'igrill_mini'),
+                    (re.compile(r'igrill.?v?2', re.IGNORECASE), 'igrill_v2'),
+                    (re.compile(r'igrill.?v?3', re.IGNORECASE), 'igrill_v3'),
+                    (re.compile(r'pulse.?2000', re.IGNORECASE), 'pulse_2000')]
+
+
+class DeviceAbsent(Exception):
+    """Raised when connecting to a device that is not advertising, so no connection attempt is wasted on it"""
+
+
+class TypeNotDetected(DeviceAbsent):
+    """
+    Raised for an 'auto' device whose advertisement shows no known name or service (yet). The name often only
+    arrives with a later scan response, so it is retried like an absent device
+    """
+
+
+def detect_type(name, services):
+    """Returns the device type for the advertised name and service uuids, or None if it is not a known device"""
+    for service in services:
+        if service.lower() in ADVERTISED_SERVICES:
+            return ADVERTISED_SERVICES[service.lower()]
+    for pattern, device_type in ADVERTISED_NAMES:
+        if name and pattern.search(name):
+            return device_type
+    return None
+
+
+class Advertisement(object):
+    def __init__(self):
+        self.rssi = None
+        self.name = None
+        self.services = []
+        self.seen_at = 0
+
+
+class PresenceScanner(btle.DefaultDelegate):
+    """
+    Scans for advertising devices in a background thread, keeping the signal strength, name and services of every
+    device seen. A device is present while it was seen within the last timeout seconds. Scans alternate with
+    pauses, so connections on the same adapter are not held up by a scan that never ends. Started with a
+    ConnectionScheduler, every scan holds a connection slot of the adapter, as BlueZ fails connects (and scans)
+    on an adapter that is already scanning.
+    """
+
+    # Replaced by the simulator, so simulated devices can be scanned for
+    scanner_type = btle.Scanner
+
+    def __init__(self, adapter=0, scan_duration=5, scan_pause=5, timeout=30, passive=False):
+        btle.DefaultDelegate.__init__(self)
+        self.adapter = adapter
+        self.scan_duration = scan_duration
+        self.scan_pause = scan_pause
+        self.timeout = timeout
+        self.passive = passive
+        self.lock = threading.Lock()
+        self.advertisements = {}
+        self.thread = None
+        self.scheduler = None
+        self.listeners = []
+        self.stop_event = threading.Event()
+
+    def handleDiscovery(self, entry, is_new_device, is_new_data):
+        with self.lock:
+            advertisement = self.advertisements.setdefault(entry.addr.lower(), Advertisement())
+            if advertisement.seen_at < time.time() - self.timeout:
+                logging.info("Device {} is advertising (rssi {} dBm)".format(entry.addr, entry.rssi))
+            advertisement.rssi = entry.rssi
+            advertisement.seen_at = time.time()
+            if is_new_data:
+                advertisement.name = entry.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME) or \
+                    entry.getValueText(btle.ScanEntry.SHORT_LOCAL_NAME) or advertisement.name
+                services = [entry.getValueText(sdid) for sdid in (btle.ScanEntry.INCOMPLETE_128B_SERVICES,
+                                                                  btle.ScanEntry.COMPLETE_128B_SERVICES)]
+                advertisement.services = [s for text in services if text for s in text.split(',')] or \
+                    advertisement.services
+
+    def get(self, address):
+        """Returns the latest advertisement of the device if it is present, otherwise None"""
+        with self.lock:
+            advertisement = self.advertisements.get(address.lower())
+            if advertisement is None or advertisement.seen_at < time.time() - self.timeout:
+                return None
+            return advertisement
+
+    def is_present(self, address):
+        return self.get(address) is not None
+
+    def rssi(self, address):
+        """Signal strength of the device in dBm, None if it is not present"""
+        advertisement = self.get(address)
+        return advertisement.rssi if advertisement else None
+
+    def device_type(self, address):
+        """
+        Returns the type of the device detected from its advertisement. Raises DeviceAbsent if it was not seen
+        yet, and TypeNotDetected if it does not advertise as a known device
+        """
+        advertisement = self.get(address)
+        if advertisement is None:
+            raise DeviceAbsent("Device {} is not advertising".format(address))
+        device_type = detect_type(advertisement.name, advertisement.services)
+        if device_type is None:
+            raise TypeNotDetected("Could not detect the type of device {} from its name '{}' and services {}".format(
+                address, advertisement.name, advertisement.services))
+        return device_type
+
+    def add_listener(self, listener):
+        """Calls listener with a snapshot of the advertisements after every scan"""
+        self.listeners.append(listener)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.advertisements)
+
+    def update(self, advertisements):
+        """Replaces the advertisements with a snapshot taken by a scanner in another process"""
+        with self.lock:
+            self.advertisements = advertisements
+
+    def forget_absent(self):
+        """Drops devices that were not seen for a while, so passers-by do not pile up"""
+        with self.lock:
+            absent_since = time.time() - 10 * self.timeout
+            for address in [a for a, adv in self.advertisements.items() if adv.seen_at < absent_since]:
+                del self.advertisements[address]
+
+    def run(self):
+        scanner = self.scanner_type(self.adapter).withDelegate(self)
+        while not self.stop_event.is_set():
+            try:
+                with self.scheduler.connecting(self.adapter) if self.scheduler else nullcontext():
+                    scanner.scan(self.scan_duration, passive=self.passive)
+            except btle.BTLEException as e:
+                # Scanning needs root (or CAP_NET_ADMIN)
+                logging.error("Scanning on adapter hci{} failed: {}".format(self.adapter, e))
+                self.stop_event.wait(self.scan_duration)
+            self.forget_absent()
+            if self.listeners:
+                snapshot = self.snapshot()
+                for listener in self.listeners:
+                    listener(snapshot)
+            self.stop_event.wait(self.scan_pause)
+
+    def start(self, scheduler=None):
+        """Starts scanning, taking a connection slot of the scheduler for every scan if given"""
+        self.scheduler = scheduler
+        self.thread = threading.Thread(target=self.run, name='PresenceScanner')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("Scanning for devices on adapter hci{}".format(self.adapter))
+
+    def stop(self):
+        self.stop_event.set()
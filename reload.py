@@ -0,0 +1,198 @@
+from builtins import object
+import logging
+import os
+import threading
+
+from config import Config
+from health import device_status
+from sinks import DeadbandSink, Sink
+from utils import assemble_sink, config_requirements, config_defaults, create_sink_part, deadband_config, sink_parts
+
+# Device settings applied to a running device. Changing any other setting restarts the device
+IN_PLACE_KEYS = ('topic', 'interval', 'publish_missing_probes', 'missing_probe_value', 'adaptive_interval')
+
+# Top level settings that only take effect on restart
+RESTART_KEYS = ('handle_cache', 'bluetooth', 'reconnect', 'metrics', 'presence')
+
+
+def without(device_config, keys):
+    return {k: v for k, v in device_config.items() if k not in keys}
+
+
+def diff_devices(old_devices, new_devices):
+    """
+    Compares two device lists by name. Returns the names of removed devices, the configs of added devices, the
+    configs of devices that have to be restarted and the configs of devices that can be updated in place
+    """
+    old = {d['name']: d for d in old_devices or []}
+    new = {d['name']: d for d in new_devices or []}
+    removed = [name for name in old if name not in new]
+    added = [d for name, d in new.items() if name not in old]
+    restarted = []
+    updated = []
+    for name, d in new.items():
+        if name not in old or d == old[name]:
+            continue
+        # Deadbands are applied by the sink, not the device
+        if without(d, IN_PLACE_KEYS + ('deadband',)) != without(old[name], IN_PLACE_KEYS + ('deadband',)):
+            restarted.append(d)
+        elif without(d, ('deadband',)) != without(old[name], ('deadband',)):
+            updated.append(d)
+    return removed, added, restarted, updated
+
+
+class ReloadableSink(Sink):
+    """
+    Forwards readings to a sink built from the config, whose parts can be replaced by rebuild() while devices
+    publish. Deadbands are always in front of the MQTT/CloudWatch connection, so their settings can be updated in
+    place. Readings published while parts are rebuilt are held, and published to the new sink once it is in place.
+    """
+
+    def __init__(self, config):
+        self.lock = threading.Lock()
+        self.held = None
+        self.part_configs = sink_parts(config)
+        self.parts = {name: create_sink_part(name, part_config) for name, part_config in self.part_configs.items()}
+        self.deadbands = DeadbandSink(self.parts['upstream'], deadband_config(config))
+        self.sink = assemble_sink(self.deadbands, self.parts)
+
+    def connect(self):
+        self.sink.connect()
+
+    def publish(self, reading):
+        with self.lock:
+            if self.held is not None:
+                self.held.append(reading)
+                return
+            self.sink.publish(reading)
+
+    def changed(self, config):
+        """Whether rebuild() has to replace any part of the sink for the given config"""
+        return sink_parts(config) != self.part_configs
+
+    def configure_deadbands(self, deadbands):
+        self.deadbands.configure(deadbands)
+
+    def replace_parts(self, part_configs):
+        """
+        Closes the parts whose config changed, flushing or spooling their buffered readings, and builds them anew.
+        Parts whose config did not change, like the history and its buffered readings, are kept
+        """
+        for name in set(self.part_configs) | set(part_configs):
+            if self.part_configs.get(name) == part_configs.get(name):
+                continue
+            if name in self.parts:
+                self.parts.pop(name).close()
+            self.part_configs.pop(name, None)
+            if name in part_configs:
+                self.parts[name] = create_sink_part(name, part_configs[name])
+                self.parts[name].connect()
+                self.part_configs[name] = part_configs[name]
+
+    def rebuild(self, config, fallback_config=None):
+        """
+        Replaces the parts of the sink whose settings changed. If building one fails, the parts are built from
+        fallback_config instead and False is returned. Devices keep publishing meanwhile, their readings are held
+        until the new sink is in place
+        """
+        with self.lock:
+            self.held = []
+        try:
+            self.replace_parts(sink_parts(config))
+            return True
+        except Exception:
+            if fallback_config is None:
+                raise
+            logging.exception("Failed to build the sink from the new config, keeping the running config")
+            self.replace_parts(sink_parts(fallback_config))
+            return False
+        finally:
+            with self.lock:
+                self.deadbands.sink = self.parts['upstream']
+                self.sink = assemble_sink(self.deadbands, self.parts)
+                for reading in self.held:
+                    self.sink.publish(reading)
+                self.held = None
+
+    def close(self):
+        self.sink.close()
+
+
+class ConfigReloader(object):
+    """
+    Re-reads the config directory and applies the changes to a running engine: removed and added devices are
+    stopped and started, devices with changed connection settings are restarted, and changed intervals, topics
+    and other device settings are applied in place. Only the parts of the sink whose settings changed are rebuilt,
+    deadbands are updated in place.
+    """
+
+    def __init__(self, config_directory, config, sink, monitor_factory, watch_interval=None):
+        self.config_directory = config_directory
+        self.config = config
+        self.sink = sink
+        self.monitor_factory = monitor_factory
+        self.watch_interval = watch_interval
+        self.mtime = self.config_mtime()
+
+    def config_mtime(self):
+        """Latest modification time of the config directory and the files in it"""
+        try:
+            return max([os.path.getmtime(self.config_directory)] +
+                       [os.path.getmtime(os.path.join(self.config_directory, f))
+                        for f in os.listdir(self.config_directory)])
+        except OSError:
+            return None
+
+    def changed(self):
+        return self.config_mtime() != self.mtime
+
+    def reload(self, engine):
+        logging.info("Reloading config from {}".format(self.config_directory))
+        self.mtime = self.config_mtime()
+        try:
+            config = Config(self.config_directory, config_requirements, config_defaults)
+        except Exception:
+            logging.exception("Failed to read config from {}, keeping the running config".format(self.config_directory))
+            return
+        if not config.isvalid():
+            logging.error("Config found in directory {} is not valid, keeping the running config".format(
+                self.config_directory))
+            return
+        new_config = config.get_config()
+        try:
+            # Built up front, so invalid settings leave the running config untouched
+            deadbands = DeadbandSink.build(deadband_config(new_config))
+        except Exception:
+            logging.exception("Invalid deadband settings in {}, keeping the running config".format(
+                self.config_directory))
+            return
+
+        for key in RESTART_KEYS:
+            if new_config.get(key) != self.config.get(key):
+                logging.warning("Changes to '{}' only take effect after a restart".format(key))
+
+        if self.sink.changed(new_config):
+            logging.info("Sink settings changed, rebuilding the sink")
+            if not self.sink.rebuild(new_config, self.config):
+                return
+        if deadband_config(new_config) != deadband_config(self.config):
+            logging.info("Deadbands changed, updating them")
+            self.sink.configure_deadbands(deadbands)
+
+        removed, added, restarted, updated = diff_devices(self.config.get('devices'), new_config.get('devices'))
+        for name in removed:
+            logging.info("Device {} removed".format(name))
+            engine.remove_monitor(name)
+            device_status.remove(name)
+        for device_config in restarted:
+            logging.info("Device {} changed, restarting it".format(device_config['name']))
+            engine.remove_monitor(device_config['name'])
+        for device_config in added + restarted:
+            engine.add_monitor(self.monitor_factory(device_config))
+        for device_config in updated:
+            engine.monitors[device_config['name']].reconfigure(**{k: v for k, v in device_config.items()
+                                                                  if k in IN_PLACE_KEYS})
+
+        self.config = new_config
+        logging.info("Config reloaded: {} added, {} removed, {} restarted, {} updated".format(
+            len(added), len(removed), len(restarted), len(updated)))
@@ -0,0 +1,92 @@
+from builtins import object
+from contextlib import contextmanager, nullcontext
+import itertools
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+
+class ConnectionScheduler(object):
+    """
+    Assigns devices to HCI adapters and limits the number of concurrent connection attempts on each adapter.
+    Devices without a configured adapter are balanced across the available adapters. With a presence scanner,
+    devices waiting for a connection slot get it strongest signal first, otherwise in the order they asked. With a
+    gate, its connecting context is held along with every slot, to keep connects apart from a scanner running in
+    another process.
+    """
+
+    def __init__(self, adapters=None, max_concurrent_connections=1, presence=None, gate=None):
+        self.adapters = list(adapters) if adapters else [0]
+        self.max_concurrent_connections = max_concurrent_connections
+        self.presence = presence
+        self.gate = gate
+        self.lock = threading.Lock()
+        self.slot_released = threading.Condition(self.lock)
+        self.connecting_count = {}
+        self.waiting = {}
+        self.sequence = itertools.count()
+        self.assignments = {}
+        for adapter in self.adapters:
+            self.add_adapter(adapter)
+
+    def add_adapter(self, adapter):
+        if adapter not in self.connecting_count:
+            self.connecting_count[adapter] = 0
+            self.waiting[adapter] = []
+
+    def load(self, adapter):
+        return sum(1 for a in self.assignments.values() if a == adapter)
+
+    def assign(self, address, adapter=None):
+        """
+        Returns the adapter the device with the given address should connect through. Uses the given adapter if
+        set, the previous assignment if any, and otherwise the adapter with the fewest assigned devices.
+        """
+        with self.lock:
+            if adapter is None:
+                adapter = self.assignments.get(address)
+            if adapter is None:
+                adapter = min(self.adapters, key=self.load)
+            self.add_adapter(adapter)
+            self.assignments[address] = adapter
+            logging.debug("Assigned device {} to adapter hci{}".format(address, adapter))
+            return adapter
+
+    def release(self, address):
+        with self.lock:
+            self.assignments.pop(address, None)
+
+    def priority(self, address):
+        """Devices with a stronger signal go first, devices without a known signal strength last"""
+        rssi = self.presence.rssi(address) if self.presence is not None and address else None
+        return rssi if rssi is not None else float('-inf')
+
+    @contextmanager
+    def connecting(self, adapter, address=None):
+        """Held while connecting the device with the given address through the given adapter"""
+        waiting_since = time.time()
+        with self.slot_released:
+            self.add_adapter(adapter)
+            # The priority is fixed when starting to wait, so every waiter agrees on who is next
+            waiter = (self.priority(address), -next(self.sequence))
+            self.waiting[adapter].append(waiter)
+            while self.connecting_count[adapter] >= self.max_concurrent_connections or \
+                    waiter != max(self.waiting[adapter]):
+                self.slot_released.wait()
+            self.waiting[adapter].remove(waiter)
+            self.connecting_count[adapter] += 1
+            # Another slot may still be free for the next waiter
+            self.slot_released.notify_all()
+        try:
+            with self.gate.connecting(adapter) if self.gate is not None else nullcontext():
+                metrics.observe('igrill_connection_slot_wait_seconds', time.time() - waiting_since, adapter=adapter)
+                logging.debug("Acquired connection slot on adapter hci{}".format(adapter))
+                with metrics.timer('igrill_connection_slot_held_seconds', adapter=adapter):
+                    yield
+        finally:
+            with self.slot_released:
+                self.connecting_count[adapter] -= 1
+                self.slot_released.notify_all()
+            logging.debug("Released connection slot on adapter hci{}".format(adapter))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+Binary session log of every reading: fixed size records, appended through a memory mapped file
+
+Usage: sessionlog.py <session log file>... > readings.csv
+"""
+
+from builtins import object
+from builtins import range
+from collections import namedtuple
+import argparse
+import csv
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from sinks import Sink
+
+# magic, version, record size, number of records, created
+HEADER = struct.Struct('<8sHHQd')
+HEADER_COUNT_OFFSET = struct.calcsize('<8sHH')
+HEADER_SIZE = 64
+MAGIC = b'IGRLOG01'
+VERSION = 2
+
+# Device names follow the header, each prefixed with its length in bytes. Records refer to them by index.
+NAME_LENGTH = struct.Struct('<H')
+NAME_TABLE_SIZE = 4096
+DATA_OFFSET = HEADER_SIZE + NAME_TABLE_SIZE
+
+# timestamp, device index, probe1..4, battery, flags (bit n-1 set: probe n reported missing_probe_value)
+RECORD = struct.Struct('<dH4ffI')
+# Version 1 records have the device name inline, truncated to 16 bytes, and no name table
+RECORD_V1 = struct.Struct('<d16s4ffI')
+
+Record = namedtuple('Record', ['timestamp', 'device_name', 'probe1', 'probe2', 'probe3', 'probe4', 'battery',
+                               'flags'])
+
+
+def numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SessionLogWriter(object):
+    """
+    Appends readings to session log files in the given directory. Each file is preallocated for records_per_file
+    records and written through a memory map, flushed to disk every flush_interval seconds. Full files, or files
+    whose name table has no room for another device, are trimmed to their size and a new file is started.
+    """
+
+    def __init__(self, directory, records_per_file=100000, flush_interval=10):
+        self.directory = directory
+        self.records_per_file = records_per_file
+        self.flush_interval = flush_interval
+        self.file = None
+        self.map = None
+        self.path = None
+        self.count = 0
+        self.devices = {}
+        self.names_end = HEADER_SIZE
+        self.flushed_at = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open(self, timestamp):
+        self.path = os.path.join(self.directory, time.strftime('session-%Y%m%d-%H%M%S.igl', time.localtime(timestamp)))
+        suffix = 1
+        while os.path.exists(self.path):
+            self.path = os.path.join(self.directory, time.strftime('session-%Y%m%d-%H%M%S', time.localtime(timestamp)) +
+                                     "-{}.igl".format(suffix))
+            suffix += 1
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(DATA_OFFSET + self.records_per_file * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.count = 0
+        self.devices = {}
+        self.names_end = HEADER_SIZE
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, RECORD.size, 0, timestamp)
+        self.flushed_at = time.time()
+        logging.info("Writing session log to {}".format(self.path))
+
+    def device_index(self, device_name):
+        """Index of the device in the name table of the current file, adding it if needed. None if the table is full"""
+        if device_name not in self.devices:
+            name = device_name.encode('utf-8')
+            if NAME_LENGTH.size + len(name) > NAME_TABLE_SIZE:
+                raise ValueError("Device name '{}' is too long for the session log".format(device_name))
+            if self.names_end + NAME_LENGTH.size + len(name) > DATA_OFFSET:
+                return None
+            NAME_LENGTH.pack_into(self.map, self.names_end, len(name))
+            self.map[self.names_end + NAME_LENGTH.size:self.names_end + NAME_LENGTH.size + len(name)] = name
+            self.names_end += NAME_LENGTH.size + len(name)
+            self.devices[device_name] = len(self.devices)
+        return self.devices[device_name]
+
+    def write(self, reading):
+        if self.map is None:
+            self.open(reading.timestamp)
+        device_index = self.device_index(reading.device_name)
+        if device_index is None:
+            self.close()
+            self.open(reading.timestamp)
+            device_index = self.device_index(reading.device_name)
+
+        probes = []
+        flags = 0
+        for i in range(1, 5):
+            value = reading.temperatures.get(i)
+            if not numeric(value) and value:
+                flags |= 1 << (i - 1)
+            probes.append(float(value) if numeric(value) else float('nan'))
+        battery = float(reading.battery) if numeric(reading.battery) else float('nan')
+        RECORD.pack_into(self.map, DATA_OFFSET + self.count * RECORD.size, reading.timestamp, device_index,
+                         probes[0], probes[1], probes[2], probes[3], battery, flags)
+        self.count += 1
+
+        if self.count >= self.records_per_file:
+            self.close()
+        elif time.time() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.map is not None:
+            struct.pack_into('<Q', self.map, HEADER_COUNT_OFFSET, self.count)
+            self.map.flush()
+            self.flushed_at = time.time()
+
+    def close(self):
+        """Flushes and closes the current file, trimming it to the records written"""
+        if self.map is None:
+            return
+        self.flush()
+        self.map.close()
+        self.file.truncate(DATA_OFFSET + self.count * RECORD.size)
+        self.file.close()
+        self.map = None
+        self.file = None
+
+
+class SessionLog(object):
+    """
+    Read only view of a session log file. Records are decoded from the memory map on access, so iterating or
+    slicing a multi-day log never copies the file into memory. Iterators copy chunk_size records at a time out of
+    the map and hold no reference into it, so the log can be closed while they are alive.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, count, self.created = HEADER.unpack_from(self.map, 0)
+        self.record = RECORD if version == VERSION else RECORD_V1
+        if magic != MAGIC or version not in (1, VERSION) or record_size != self.record.size:
+            raise ValueError("{} is not a version {} session log".format(path, VERSION))
+        self.data_offset = DATA_OFFSET if version == VERSION else HEADER_SIZE
+        self.names = self.read_names() if version == VERSION else None
+        capacity = (len(self.map) - self.data_offset) // self.record.size
+        # Records written after the last flush of a file that was not closed cleanly are recovered as well
+        while count < capacity and self.record.unpack_from(self.map, self.offset(count))[0] != 0:
+            count += 1
+        self.count = count
+
+    def read_names(self):
+        names = []
+        position = HEADER_SIZE
+        while position + NAME_LENGTH.size <= DATA_OFFSET:
+            length, = NAME_LENGTH.unpack_from(self.map, position)
+            if not length:
+                break
+            position += NAME_LENGTH.size
+            names.append(self.map[position:position + length].decode('utf-8', 'replace'))
+            position += length
+        return names
+
+    def offset(self, index):
+        return self.data_offset + index * self.record.size
+
+    def __len__(self):
+        return self.count
+
+    def decode(self, values):
+        timestamp, device, probe1, probe2, probe3, probe4, battery, flags = values
+        if self.names is None:
+            device_name = device.rstrip(b'\0').decode('utf-8', 'replace')
+        else:
+            device_name = self.names[device] if device < len(self.names) else ''
+        return Record(timestamp, device_name, probe1, probe2, probe3, probe4, battery, flags)
+
+    def iterate(self, start, stop):
+        for chunk_start in range(start, stop, self.chunk_size):
+            chunk = self.map[self.offset(chunk_start):self.offset(min(stop, chunk_start + self.chunk_size))]
+            for values in self.record.iter_unpack(chunk):
+                yield self.decode(values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                raise ValueError("Session log slices do not support steps")
+            return self.iterate(start, stop)
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("Record index out of range")
+        return self.decode(self.record.unpack_from(self.map, self.offset(index)))
+
+    def __iter__(self):
+        return self[:]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SessionLogSink(Sink):
+    """
+    Writes every reading to the binary session log
+    """
+
+    def __init__(self, directory, records_per_file=100000, flush_interval=10):
+        self.writer = SessionLogWriter(directory, records_per_file, flush_interval)
+        self.lock = threading.Lock()
+
+    def publish(self, reading):
+        with self.lock:
+            self.writer.write(reading)
+
+    def close(self):
+        with self.lock:
+            self.writer.close()
+
+
+def to_csv(paths, output):
+    writer = csv.writer(output)
+    writer.writerow(Record._fields)
+    for path in paths:
+        log = SessionLog(path)
+        try:
+            for record in log:
+                writer.writerow(['' if isinstance(value, float) and math.isnan(value) else value for value in record])
+        finally:
+            log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert igrill session logs to CSV')
+    parser.add_argument('paths', nargs='+', help='Session log files, in order')
+    options = parser.parse_args()
+    to_csv(options.paths, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
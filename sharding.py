@@ -0,0 +1,463 @@
+from builtins import object
+from contextlib import contextmanager
+import copy
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from config import strip_config
+from health import DeviceState, ReconnectPolicy, device_status
+from sinks import Sink
+
+
+class PipeSink(Sink):
+    """
+    Passes the readings of a worker process on to the parent process, which publishes them. Every shard has a pipe
+    of its own, so a worker killed in the middle of a send only breaks its own pipe
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.connection.send(message)
+
+    def publish(self, reading):
+        self.send(('reading', reading))
+
+
+def shard_handle_cache(path, shard):
+    """Every shard keeps its own handle cache file, so worker processes never overwrite each other's handles"""
+    if not path:
+        return None
+    root, extension = os.path.splitext(path)
+    return "{}-shard{}{}".format(root, shard, extension)
+
+
+class AdapterGate(object):
+    """
+    Keeps the scans of the parent and the connects of the workers apart on the adapter the parent scans on, as BlueZ
+    fails connects on an adapter that is scanning. Like a scan holding a slot of the ConnectionScheduler, a scan
+    waits until no connect is waiting or running. Every shard counts its connects in slots of its own, which are
+    cleared once its worker stopped, so a killed worker cannot block the adapter. The lock is only held to check
+    and update the counts, never while waiting
+    """
+
+    # Seconds between checks while waiting for the other side
+    poll_interval = 0.1
+
+    def __init__(self, context, adapter, shards):
+        self.adapter = adapter
+        self.lock = context.Lock()
+        self.scanning = context.RawValue('b', 0)
+        self.waiting = context.RawArray('i', shards)
+        self.connects = context.RawArray('i', shards)
+        # Slot of the worker the gate was handed to, None in the parent
+        self.shard = None
+
+    def for_shard(self, shard):
+        gate = copy.copy(self)
+        gate.shard = shard
+        return gate
+
+    def clear(self, shard):
+        with self.lock:
+            self.waiting[shard] = 0
+            self.connects[shard] = 0
+
+    def wait_until(self, condition):
+        """Waits until condition, called with the lock held, returns True"""
+        while True:
+            with self.lock:
+                if condition():
+                    return
+            time.sleep(self.poll_interval)
+
+    @contextmanager
+    def connecting(self, adapter):
+        """Held around a connect in a worker, and around a scan in the parent"""
+        if adapter != self.adapter:
+            yield
+        elif self.shard is None:
+            def idle():
+                if any(self.waiting) or any(self.connects):
+                    return False
+                self.scanning.value = 1
+                return True
+
+            self.wait_until(idle)
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.scanning.value = 0
+        else:
+            def not_scanning():
+                if self.scanning.value:
+                    return False
+                self.waiting[self.shard] -= 1
+                self.connects[self.shard] += 1
+                return True
+
+            with self.lock:
+                self.waiting[self.shard] += 1
+            self.wait_until(not_scanning)
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.connects[self.shard] -= 1
+
+
+def run_shard(shard, device_configs, connection, control, heartbeat, settings, gate=None):
+    """
+    Entry point of a worker process. Runs the given devices in threads, sending their readings and state changes
+    to the parent through connection, until SIGTERM. The parent sends setting changes of the devices through
+    control. With a gate, the parent scans instead of the shard and sends the presence snapshots through control
+    as well, and connects hold the gate.
+
+    The heartbeat shared value is set to the current time every heartbeat_interval seconds, independent of how fast
+    the parent reads the pipe, as long as no device is stuck in a poll for longer than heartbeat_timeout seconds,
+    like it is when its bluepy-helper wedged. Connects are not covered, as waiting for a connection slot can
+    legitimately take that long
+    """
+    import utils
+    from engine import ThreadEngine
+    from handlecache import HandleCache
+    from scheduler import ConnectionScheduler
+
+    utils.log_setup(settings['log_level'], settings['log_destination'])
+    sink = PipeSink(connection)
+    device_status.add_listener(lambda name, status: sink.send(('status', name, status)))
+
+    handle_cache = HandleCache(shard_handle_cache(settings.get('handle_cache'), shard))
+    presence = utils.create_presence(settings, device_configs)
+    scheduler = ConnectionScheduler(presence=presence, gate=gate, **strip_config(settings.get('bluetooth') or {},
+                                                                      ['adapters', 'max_concurrent_connections']))
+    if presence is not None and gate is None:
+        # Sharded by adapter, the shard is the only one using its adapter
+        presence.start(scheduler)
+    reconnect_policy = ReconnectPolicy(**strip_config(settings.get('reconnect') or {},
+                                                      ['initial_delay', 'max_delay', 'max_attempts']))
+    monitors = utils.get_device_monitors(device_configs, sink, handle_cache, scheduler, reconnect_policy,
+                                         presence)
+    monitors_by_name = {monitor.name: monitor for monitor in monitors}
+
+    def beat():
+        stuck = []
+        while True:
+            now = time.time()
+            previously_stuck = stuck
+            stuck = [monitor.name for monitor in monitors if monitor.polling_since is not None and
+                     now - monitor.polling_since > settings['heartbeat_timeout']]
+            if not stuck:
+                heartbeat.value = now
+            elif not previously_stuck:
+                logging.error("Stopping the heartbeat, devices stuck in a poll: {}".format(', '.join(stuck)))
+            time.sleep(settings['heartbeat_interval'])
+
+    def receive():
+        while True:
+            try:
+                message = control.recv()
+            except EOFError:
+                return
+            if message[0] == 'presence' and presence is not None:
+                presence.update(message[1])
+            elif message[0] == 'reconfigure' and message[1] in monitors_by_name:
+                _, name, device_settings = message
+                monitors_by_name[name].reconfigure(**device_settings)
+
+    for target, name in ((beat, 'Heartbeat'), (receive, 'ControlReceiver')):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+    logging.info("Shard {} running {} devices in process {}".format(shard, len(monitors), os.getpid()))
+    ThreadEngine(monitors).run()
+
+
+class ShardedDevice(object):
+    """
+    Stands in for the DeviceMonitor of a device running in a worker process. Changed settings are sent on to the
+    worker, which applies them in place
+    """
+
+    def __init__(self, device_config):
+        self.name = device_config['name']
+        self.config = device_config
+        self.shard = None
+
+    def reconfigure(self, **settings):
+        self.config = dict(self.config, **settings)
+        # Kept up to date, so a restarted worker starts with the new settings
+        self.shard.devices[self.name] = self.config
+        self.shard.send(('reconfigure', self.name, settings))
+
+
+class Shard(object):
+    def __init__(self, key):
+        self.key = key
+        self.devices = {}
+        self.process = None
+        self.started_at = None
+        # Pipe setting changes and presence snapshots are sent to the worker through
+        self.control = None
+        self.control_lock = threading.Lock()
+        # Shared with the worker, which sets it to the time of its latest heartbeat
+        self.heartbeat = None
+        self.failures = 0
+        self.restart_at = None
+        # Set when the devices of the shard changed, so it has to be (re)started
+        self.dirty = False
+
+    def send(self, message):
+        with self.control_lock:
+            if self.control is None:
+                return
+            try:
+                self.control.send(message)
+            except OSError:
+                # The worker exited, the supervisor restarts it
+                pass
+
+    def close_control(self):
+        with self.control_lock:
+            if self.control is not None:
+                self.control.close()
+                self.control = None
+
+
+class ProcessEngine(object):
+    """
+    Shards the devices across worker processes, either evenly by count or one shard per bluetooth adapter. Workers
+    run their devices in threads and stream the readings to this (parent) process, which owns the sink and the
+    state of every device. Each shard is supervised on its own: a worker that exits, or stops sending heartbeats,
+    is restarted with backoff, without affecting the other shards. With a reloader, only shards whose devices
+    changed are restarted on reload, changed settings of a device are applied in place.
+
+    Only one scanner may run per adapter. Sharded by adapter, every shard scans its own adapter. Sharded by count,
+    the shards share the adapter, so this process scans and sends the advertisements to the shards, with its scans
+    and the connects of the shards kept apart by an AdapterGate.
+    """
+
+    # Seconds a restarted shard has to run before its failures are forgotten
+    stable_after = 300
+
+    def __init__(self, config, sink, shards=None, shard_by='count', reloader=None, log_level='INFO',
+                 log_destination='', heartbeat_interval=5, heartbeat_timeout=60, stop_timeout=30):
+        if shard_by not in ('count', 'adapter'):
+            raise ValueError("Unknown shard mode: {}".format(shard_by))
+        self.config = config
+        self.sink = sink
+        self.shard_by = shard_by
+        self.reloader = reloader
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stop_timeout = stop_timeout
+        self.settings = {'log_level': log_level,
+                         'log_destination': log_destination,
+                         'heartbeat_interval': heartbeat_interval,
+                         'heartbeat_timeout': heartbeat_timeout,
+                         'handle_cache': config.get('handle_cache'),
+                         'bluetooth': config.get('bluetooth'),
+                         'reconnect': config.get('reconnect')}
+        if 'presence' in config:
+            self.settings['presence'] = config['presence']
+        self.restart_policy = ReconnectPolicy(initial_delay=1, max_delay=60)
+        # Processes are spawned, not forked, as the parent already runs the threads of the sinks
+        self.context = multiprocessing.get_context('spawn')
+        # Threads forwarding what the workers send, one per started worker
+        self.forwarders = []
+        self.presence = None
+        self.gate = None
+
+        if shard_by == 'adapter':
+            keys = (config.get('bluetooth') or {}).get('adapters') or [0]
+        else:
+            keys = range(shards or multiprocessing.cpu_count())
+        self.shards = {key: Shard(key) for key in keys}
+        self.monitors = {}
+        self.stopping = False
+        self.reload_requested = False
+        self.wake_event = threading.Event()
+
+    def assign(self, device_config):
+        """Returns the shard a new device runs in"""
+        if self.shard_by == 'adapter' and device_config.get('adapter') is not None:
+            adapter = device_config['adapter']
+            if adapter not in self.shards:
+                self.shards[adapter] = Shard(adapter)
+            return self.shards[adapter]
+        return min(self.shards.values(), key=lambda shard: len(shard.devices))
+
+    def add_monitor(self, device):
+        device.shard = self.assign(device.config)
+        if self.shard_by == 'adapter':
+            # Devices without an adapter use the adapter of the shard they were assigned to
+            device.config = dict(device.config, adapter=device.shard.key)
+        device.shard.devices[device.name] = device.config
+        device.shard.dirty = True
+        self.monitors[device.name] = device
+
+    def remove_monitor(self, name):
+        device = self.monitors.pop(name)
+        del device.shard.devices[name]
+        device.shard.dirty = True
+
+    def start_shard(self, shard):
+        settings = self.settings
+        if self.shard_by == 'adapter' and 'presence' in settings:
+            settings = dict(settings, presence=dict(settings['presence'] or {}, adapter=shard.key))
+        receiver, sender = self.context.Pipe(duplex=False)
+        shard.heartbeat = self.context.RawValue('d', 0)
+        control_receiver, shard.control = self.context.Pipe(duplex=False)
+        shard.process = self.context.Process(target=run_shard, name="Shard{}".format(shard.key),
+                                             args=(shard.key, list(shard.devices.values()), sender, control_receiver,
+                                                   shard.heartbeat, settings,
+                                                   self.gate and self.gate.for_shard(shard.key)))
+        shard.process.daemon = True
+        shard.process.start()
+        # Only the worker writes to the pipe, so the forwarder sees the end of it once the worker exits
+        sender.close()
+        control_receiver.close()
+        if self.presence is not None:
+            shard.send(('presence', self.presence.snapshot()))
+        forwarder = threading.Thread(target=self.forward, args=(shard.key, receiver),
+                                     name="ShardForward{}".format(shard.key))
+        forwarder.daemon = True
+        forwarder.start()
+        self.forwarders.append(forwarder)
+        shard.started_at = time.time()
+        shard.restart_at = None
+        logging.info("Started shard {} with devices {} in process {}".format(
+            shard.key, ', '.join(shard.devices), shard.process.pid))
+
+    def stop_shard(self, shard, timeout):
+        """Asks the worker to stop, killing it if it did not within timeout seconds"""
+        process = shard.process
+        shard.process = None
+        shard.close_control()
+        if process is not None and process.is_alive():
+            process.terminate()
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("Shard {} did not stop within {} seconds, killing it".format(shard.key, timeout))
+                process.kill()
+                process.join()
+        if self.gate is not None:
+            # Connects the worker was in the middle of are over
+            self.gate.clear(shard.key)
+
+    def schedule_restart(self, shard, reason):
+        delay = self.restart_policy.delay(shard.failures)
+        shard.failures += 1
+        shard.restart_at = time.time() + delay
+        logging.error("Shard {} {}, restarting it in {:.1f} seconds".format(shard.key, reason, delay))
+        for name in shard.devices:
+            device_status.update(name, DeviceState.BACKING_OFF, "Shard {}".format(reason), delay)
+
+    def supervise(self):
+        now = time.time()
+        self.forwarders = [forwarder for forwarder in self.forwarders if forwarder.is_alive()]
+        for shard in list(self.shards.values()):
+            if shard.dirty:
+                shard.dirty = False
+                self.stop_shard(shard, self.stop_timeout)
+                if shard.devices:
+                    self.start_shard(shard)
+                continue
+
+            process = shard.process
+            if process is not None and process.is_alive():
+                if now - max(shard.started_at, shard.heartbeat.value) > self.heartbeat_timeout:
+                    self.stop_shard(shard, 5)
+                    self.schedule_restart(shard, "sent no heartbeat for {} seconds".format(self.heartbeat_timeout))
+                elif shard.failures and now - shard.started_at > self.stable_after:
+                    shard.failures = 0
+            elif process is not None:
+                self.stop_shard(shard, 0)
+                self.schedule_restart(shard, "exited with code {}".format(process.exitcode))
+            elif shard.restart_at is not None and now >= shard.restart_at and shard.devices:
+                self.start_shard(shard)
+
+    def forward(self, key, connection):
+        """Publishes the readings, and applies the state changes, sent by the worker of a shard until it exits"""
+        while True:
+            try:
+                message = connection.recv()
+            except EOFError:
+                break
+            except Exception:
+                # A worker killed in the middle of a send leaves a partial message behind
+                logging.exception("Failed to read from shard {}, dropping the rest of its pipe".format(key))
+                break
+            if message[0] == 'reading':
+                try:
+                    self.sink.publish(message[1])
+                except Exception:
+                    logging.exception("Failed to publish reading from {}".format(message[1].device_name))
+            elif message[0] == 'status':
+                _, name, status = message
+                # Already logged by the worker
+                if name in self.monitors:
+                    device_status.update(name, status['state'], status['error'], status['retry_in'], log=False)
+        connection.close()
+
+    def broadcast_presence(self, advertisements):
+        for shard in list(self.shards.values()):
+            shard.send(('presence', advertisements))
+
+    def stop(self, *args):
+        self.stopping = True
+        self.wake_event.set()
+
+    def request_reload(self, *args):
+        self.reload_requested = True
+        self.wake_event.set()
+
+    def run(self):
+        if self.shard_by == 'count':
+            import utils
+            self.presence = utils.create_presence(self.config, self.config.get('devices'))
+            if self.presence is not None:
+                self.gate = AdapterGate(self.context, self.presence.adapter, len(self.shards))
+                self.presence.add_listener(self.broadcast_presence)
+                self.presence.start(self.gate)
+        for device_config in self.config.get('devices') or []:
+            self.add_monitor(ShardedDevice(device_config))
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.stop)
+        if self.reloader:
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+        self.sink.connect()
+
+        while not self.stopping:
+            if self.reload_requested or (self.reloader and self.reloader.watch_interval and self.reloader.changed()):
+                self.reload_requested = False
+                try:
+                    self.reloader.reload(self)
+                except Exception:
+                    logging.exception("Failed to reload the config")
+            self.supervise()
+            self.wake_event.wait(1)
+            self.wake_event.clear()
+
+        logging.info('Signaling all shards to finish')
+        for shard in self.shards.values():
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shards.values():
+            self.stop_shard(shard, self.stop_timeout)
+        for name in self.monitors:
+            device_status.update(name, DeviceState.STOPPED)
+
+        # Everything the workers sent before exiting is still published
+        for forwarder in self.forwarders:
+            forwarder.join()
+        logging.info('All shards finished, exiting')
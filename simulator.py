@@ -0,0 +1,251 @@
+from builtins import object
+from builtins import range
+from functools import partial
+import logging
+import os
+import random
+import time
+
+import bluepy.btle as btle
+
+from igrill import UUIDS, PROBE_UNPLUGGED_VALUE, DeviceMonitor, IDevicePeripheral
+from presence import PresenceScanner
+
+# Simulated device type: (emulated device type, number of probes, has heating element)
+SIMULATED_TYPES = {'simulated_igrill_mini': ('igrill_mini', 1, False),
+                   'simulated_igrill_v2': ('igrill_v2', 4, False),
+                   'simulated_igrill_v3': ('igrill_v3', 4, False),
+                   'simulated_pulse_2000': ('pulse_2000', 4, True)}
+
+
+class SimulatedCharacteristic(object):
+    def __init__(self, uuid, handle):
+        self.uuid = uuid
+        self.handle = handle
+
+    def getHandle(self):
+        return self.handle
+
+
+class SimulatedDescriptor(object):
+    def __init__(self, uuid, handle):
+        self.uuid = uuid
+        self.handle = handle
+
+
+class SimulatedScanEntry(object):
+    def __init__(self, address, rssi, name):
+        self.addr = address
+        self.rssi = rssi
+        self.name = name
+
+    def getValueText(self, sdid):
+        return self.name if sdid == btle.ScanEntry.COMPLETE_LOCAL_NAME else None
+
+
+class SimulatedScanner(object):
+    """
+    Stands in for bluepy's Scanner, reporting the simulated devices that are switched on
+    """
+
+    # Address: (rssi, advertised name, time the device is switched on)
+    devices = {}
+
+    def __init__(self, iface=0):
+        self.delegate = None
+
+    @classmethod
+    def advertise(cls, address, name, rssi=-60, switched_on_after=0):
+        cls.devices[address.lower()] = (rssi, name, time.time() + switched_on_after)
+
+    @classmethod
+    def advertising(cls, address):
+        device = cls.devices.get(address.lower())
+        return device is None or device[2] <= time.time()
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def scan(self, timeout=10, passive=False):
+        deadline = time.time() + timeout
+        while True:
+            for address, (rssi, name, _) in list(self.devices.items()):
+                if self.advertising(address):
+                    self.delegate.handleDiscovery(SimulatedScanEntry(address, rssi, name), False, True)
+            if time.time() >= deadline:
+                return
+            time.sleep(min(0.5, deadline - time.time()))
+
+
+class SimulatedPeripheral(IDevicePeripheral):
+    """
+    In memory emulation of an iDevices thermometer, replacing every bluepy call made by IDevicePeripheral. Emulates
+    the characteristics, the challenge/response handshake, temperature notifications, GATT latency, link drops, failed
+    reads and unplugged probes, so the whole pipeline can be run without hardware.
+
+    Simulation parameters can be set per device with the 'simulation' device config entry. A device that is not
+    switched on yet does not advertise, and connecting to it fails after connect_timeout seconds.
+    """
+
+    # Handles are assigned in steps of 3 (declaration, value, client characteristic configuration)
+    first_handle = 0x20
+
+    def __init__(self, address, name='simulated', num_probes=4, has_heating_element=False, device_type='igrill_v2',
+                 latency=0.0, drop_rate=0.0, read_error_rate=0.0, unplugged=None, start_temperature=20, drift=1.0, notify_interval=1,
+                 battery=100, thresholds=None, connect_timeout=2, rssi=-60, switched_on_after=0, **kwargs):
+        self.device_type = device_type
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.read_error_rate = read_error_rate
+        self.notify_interval = notify_interval
+        self.battery = battery
+        self.thresholds = thresholds or {}
+        self.temperatures = {probe_num: float(start_temperature) for probe_num in range(1, num_probes + 1)}
+        self.unplugged = set(unplugged or [])
+        self.drift = drift
+        self.connect_timeout = connect_timeout
+        self.connected = False
+        self.authenticated = False
+        self.device_challenge = None
+        self.subscribed = set()
+        self.next_notification = 0
+        self.delegate = None
+
+        uuids = [UUIDS.FIRMWARE_VERSION, UUIDS.BATTERY_LEVEL, UUIDS.APP_CHALLENGE, UUIDS.DEVICE_CHALLENGE,
+                 UUIDS.DEVICE_RESPONSE, UUIDS.PROBE1_TEMPERATURE, UUIDS.PROBE1_THRESHOLD, UUIDS.PROBE2_TEMPERATURE,
+                 UUIDS.PROBE2_THRESHOLD, UUIDS.PROBE3_TEMPERATURE, UUIDS.PROBE3_THRESHOLD, UUIDS.PROBE4_TEMPERATURE,
+                 UUIDS.PROBE4_THRESHOLD, UUIDS.HEATING_ELEMENTS]
+        self.gatt = [SimulatedCharacteristic(uuid, self.first_handle + 3 * i + 1) for i, uuid in enumerate(uuids)]
+        self.gatt_handles = {str(c.uuid): c.handle for c in self.gatt}
+        self.probe_handles = {self.gatt_handles[str(getattr(UUIDS, "PROBE{}_TEMPERATURE".format(probe_num)))]: probe_num
+                              for probe_num in range(1, num_probes + 1)}
+        self.threshold_handles = {self.gatt_handles[str(getattr(UUIDS, "PROBE{}_THRESHOLD".format(probe_num)))]: probe_num
+                                  for probe_num in range(1, num_probes + 1)}
+
+        IDevicePeripheral.__init__(self, address, name, num_probes, has_heating_element=has_heating_element, **kwargs)
+
+    def operation(self):
+        """Emulates the latency and unreliability of a single GATT operation"""
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.connected:
+            raise btle.BTLEDisconnectError("Simulated device {} is not connected".format(self.address))
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.connected = False
+            raise btle.BTLEDisconnectError("Simulated link drop on {}".format(self.address))
+
+    def connect_peripheral(self, address, adapter):
+        if not SimulatedScanner.advertising(address):
+            time.sleep(self.connect_timeout)
+            raise btle.BTLEDisconnectError("Failed to connect to simulated device {}".format(address))
+        self.address = address
+        self.connected = True
+        self.operation()
+
+    def disconnect(self):
+        self.connected = False
+        self.authenticated = False
+        self.subscribed.clear()
+
+    def getState(self):
+        return 'conn' if self.connected else 'disc'
+
+    def setSecurityLevel(self, level):
+        self.operation()
+
+    def setDelegate(self, delegate):
+        self.delegate = delegate
+
+    def getCharacteristics(self):
+        self.operation()
+        return list(self.gatt)
+
+    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        self.operation()
+        descriptors = []
+        for c in self.gatt:
+            descriptors += [SimulatedDescriptor(btle.UUID(0x2803), c.handle - 1), SimulatedDescriptor(c.uuid, c.handle),
+                            SimulatedDescriptor(btle.UUID(0x2902), c.handle + 1)]
+        return [d for d in descriptors if startHnd <= d.handle <= endHnd]
+
+    def temperature(self, probe_num):
+        if probe_num in self.unplugged:
+            return PROBE_UNPLUGGED_VALUE
+        self.temperatures[probe_num] = max(0.0, self.temperatures[probe_num] + random.gauss(0, self.drift))
+        return int(self.temperatures[probe_num])
+
+    @staticmethod
+    def encode_temperature(temperature):
+        return bytes(bytearray([temperature % 256, temperature // 256]))
+
+    def readCharacteristic(self, handle):
+        self.operation()
+        if self.read_error_rate and random.random() < self.read_error_rate:
+            # A failed read that leaves the link up, like a GATT timeout on a marginal link
+            raise btle.BTLEGattError("Simulated read error on {}".format(self.address))
+        if handle == self.gatt_handles[str(UUIDS.DEVICE_CHALLENGE)] and self.device_challenge:
+            return self.device_challenge
+        if not self.authenticated:
+            raise btle.BTLEGattError("Simulated device {} is not authenticated".format(self.address))
+        if handle in self.probe_handles:
+            return self.encode_temperature(self.temperature(self.probe_handles[handle]))
+        if handle in self.threshold_handles:
+            return self.encode_temperature(int(self.thresholds.get(self.threshold_handles[handle], 0)))
+        if handle == self.gatt_handles[str(UUIDS.BATTERY_LEVEL)]:
+            return bytes(bytearray([self.battery]))
+        if handle == self.gatt_handles[str(UUIDS.HEATING_ELEMENTS)]:
+            return bytes(bytearray(4))
+        raise btle.BTLEGattError("Invalid handle {} on simulated device {}".format(handle, self.address))
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.operation()
+        if handle == self.gatt_handles[str(UUIDS.APP_CHALLENGE)]:
+            # The device answers the app challenge with its own (encrypted) challenge
+            self.device_challenge = os.urandom(16)
+        elif handle == self.gatt_handles[str(UUIDS.DEVICE_RESPONSE)]:
+            if val != self.device_challenge:
+                self.connected = False
+                raise btle.BTLEDisconnectError("Simulated device {} rejected the challenge response".format(self.address))
+            self.authenticated = True
+        elif handle - 1 in self.probe_handles and self.authenticated:
+            self.subscribed.add(handle - 1)
+        else:
+            raise btle.BTLEGattError("Invalid handle {} on simulated device {}".format(handle, self.address))
+
+    def waitForNotifications(self, timeout):
+        if not self.connected:
+            raise btle.BTLEDisconnectError("Simulated device {} is not connected".format(self.address))
+        if not self.subscribed:
+            time.sleep(timeout)
+            return False
+
+        now = time.time()
+        if self.next_notification - now > timeout:
+            time.sleep(timeout)
+            return False
+        if self.next_notification > now:
+            time.sleep(self.next_notification - now)
+        self.next_notification = time.time() + self.notify_interval
+        for handle in self.subscribed:
+            self.delegate.handleNotification(handle, self.encode_temperature(self.temperature(self.probe_handles[handle])))
+        return True
+
+
+def register(device_configs=()):
+    """
+    Makes the simulated device types available to DeviceMonitor, and the given simulated devices to the presence
+    scanner
+    """
+    for simulated_type, (device_type, num_probes, has_heating_element) in SIMULATED_TYPES.items():
+        DeviceMonitor.device_types[simulated_type] = partial(SimulatedPeripheral, device_type=device_type,
+                                                             num_probes=num_probes,
+                                                             has_heating_element=has_heating_element)
+    logging.debug("Registered simulated device types: {}".format(', '.join(sorted(SIMULATED_TYPES))))
+
+    for device_config in device_configs:
+        if device_config['type'] in SIMULATED_TYPES:
+            simulation = device_config.get('simulation') or {}
+            SimulatedScanner.advertise(device_config['address'], device_config['type'],
+                                       **{k: v for k, v in simulation.items() if k in ('rssi', 'switched_on_after')})
+    PresenceScanner.scanner_type = SimulatedScanner
@@ -0,0 +1,563 @@
+from builtins import object
+from builtins import range
+from collections import deque, namedtuple
+import json
+import logging
+import os
+import threading
+import time
+
+from metrics import metrics
+
+# device_type is the type of the connected peripheral, so devices configured with type 'auto' get their real type
+Reading = namedtuple('Reading', ['timestamp', 'device_name', 'topic', 'temperatures', 'battery', 'heating_element',
+                                 'device_type'], defaults=(None,))
+
+
+class SinkError(Exception):
+    """Raised by a sink when a reading could not be published"""
+    pass
+
+
+def reading_to_json(reading):
+    return json.dumps([reading.timestamp, reading.device_name, reading.topic, reading.temperatures, reading.battery,
+                       list(reading.heating_element) if reading.heating_element else reading.heating_element,
+                       reading.device_type], separators=(',', ':'))
+
+
+def reading_from_json(line):
+    # Readings spooled before device types were recorded have no type
+    timestamp, device_name, topic, temperatures, battery, heating_element, *device_type = json.loads(line)
+    return Reading(timestamp, device_name, topic, {int(k): v for k, v in temperatures.items()}, battery,
+                   bytearray(heating_element) if heating_element else heating_element, *device_type)
+
+
+class Sink(object):
+    """
+    Base class for everything a device reading can be published to
+    """
+
+    def connect(self):
+        """Called by the device threads whenever they (re)connect to their device"""
+        pass
+
+    def publish(self, reading):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def unpublished(self):
+        """Readings that were accepted but could not be delivered before close, so they can be spooled"""
+        return []
+
+
+class MultiSink(Sink):
+    """
+    Publishes every reading to all of the given sinks. A failing sink does not keep the others from publishing.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def connect(self):
+        for sink in self.sinks:
+            sink.connect()
+
+    def publish(self, reading):
+        for sink in self.sinks:
+            try:
+                sink.publish(reading)
+            except Exception:
+                logging.exception("Failed to publish reading from {} to {}".format(reading.device_name,
+                                                                                 type(sink).__name__))
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class MqttSink(Sink):
+    """
+    Publishes readings to MQTT through a single client shared by all devices, with its network loop running in a
+    background thread. Depending on payload_format, each probe, battery and heating element value is published on
+    its own topic ('topics'), as one document per device reading ('json' or 'msgpack'), or both ('topics+json').
+    """
+
+    payload_formats = ('topics', 'json', 'msgpack')
+
+    def __init__(self, client, payload_format='topics'):
+        self.client = client
+        self.formats = payload_format.split('+')
+        for payload_format in self.formats:
+            if payload_format not in self.payload_formats:
+                raise ValueError("Unknown MQTT payload format: {}".format(payload_format))
+        if 'msgpack' in self.formats:
+            import msgpack
+            self.packb = msgpack.packb
+        self.lock = threading.Lock()
+        self.loop_started = False
+
+    def connect(self):
+        with self.lock:
+            if not self.loop_started:
+                # The network loop handles keepalives, QoS and reconnects from here on
+                self.client.loop_start()
+                self.loop_started = True
+
+    @staticmethod
+    def document(reading):
+        document = {'timestamp': reading.timestamp}
+        for i in range(1, 5):
+            if reading.temperatures[i]:
+                document["probe{}".format(i)] = reading.temperatures[i]
+        if reading.battery:
+            document['battery'] = reading.battery
+        if reading.heating_element:
+            document['heating_element'] = list(reading.heating_element)
+        return document
+
+    def send(self, topic, payload):
+        info = self.client.publish(topic, payload)
+        # Anything but MQTT_ERR_SUCCESS means the message was not queued for the broker
+        if info.rc != 0:
+            raise SinkError("Failed to publish to {}, rc: {}".format(topic, info.rc))
+
+    def publish_topics(self, reading):
+        for i in range(1, 5):
+            if reading.temperatures[i]:
+                self.send("{0}/{1}/probe{2}".format(reading.topic, reading.device_name, i), reading.temperatures[i])
+
+        if reading.battery:
+            self.send("{0}/{1}/battery".format(reading.topic, reading.device_name), reading.battery)
+        if reading.heating_element:
+            self.send("{0}/{1}/heating_element".format(reading.topic, reading.device_name), reading.heating_element)
+
+    def publish(self, reading):
+        if 'topics' in self.formats:
+            self.publish_topics(reading)
+        if 'json' in self.formats:
+            self.send("{0}/{1}".format(reading.topic, reading.device_name),
+                      json.dumps(self.document(reading), separators=(',', ':')))
+        if 'msgpack' in self.formats:
+            self.send("{0}/{1}".format(reading.topic, reading.device_name),
+                      bytearray(self.packb(self.document(reading))))
+
+    def close(self):
+        with self.lock:
+            if self.loop_started:
+                self.client.loop_stop()
+                self.loop_started = False
+        self.client.disconnect()
+
+
+class CloudWatchSink(Sink):
+    """
+    Publishes probe and battery values as AWS CloudWatch metrics
+
+    Readings are queued and sent by a background thread, batching datums from every device into as few
+    put_metric_data calls as possible, so publishing never blocks a device thread on AWS. While CloudWatch fails,
+    publish raises SinkError, so new readings stay in (and are spooled by) a BufferedSink in front of this sink.
+    Readings still queued when closing are handed back through unpublished().
+    """
+
+    # Maximum number of datums accepted by a single put_metric_data call
+    max_datums_per_request = 1000
+
+    def __init__(self, namespace='iGrill', flush_interval=60, max_queue_size=100000, client=None):
+        self.namespace = namespace
+        self.flush_interval = flush_interval
+        if client is None:
+            # boto3 is slow to import and large, so only loaded when CloudWatch is used
+            import boto3
+            client = boto3.client('cloudwatch')
+        self.client = client
+        self.queue = deque(maxlen=max_queue_size)
+        self.queued_datums = 0
+        self.failing = False
+        self.condition = threading.Condition()
+        self.running = True
+        self.flush_thread = threading.Thread(target=self.run, name='CloudWatchFlush')
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    @staticmethod
+    def metric_data(reading):
+        dimensions = [{'Name': 'Device', 'Value': reading.device_name}]
+        data = [{'MetricName': "probe{}".format(i),
+                 'Dimensions': dimensions,
+                 'Timestamp': reading.timestamp,
+                 'Value': reading.temperatures[i]}
+                for i in range(1, 5) if reading.temperatures[i] and not isinstance(reading.temperatures[i], str)]
+        if reading.battery:
+            data.append({'MetricName': 'battery',
+                         'Dimensions': dimensions,
+                         'Timestamp': reading.timestamp,
+                         'Value': reading.battery})
+        return data
+
+    def publish(self, reading):
+        with self.condition:
+            if self.failing:
+                raise SinkError("CloudWatch is unavailable, {} readings waiting to be sent".format(len(self.queue)))
+            self.queue.append(reading)
+            self.queued_datums += len(self.metric_data(reading))
+            if self.queued_datums >= self.max_datums_per_request:
+                self.condition.notify()
+
+    def next_batch(self):
+        """Takes the readings for the next put_metric_data call off the queue. Call with the condition held"""
+        readings = []
+        data = []
+        while self.queue:
+            reading_data = self.metric_data(self.queue[0])
+            if data and len(data) + len(reading_data) > self.max_datums_per_request:
+                break
+            readings.append(self.queue.popleft())
+            data.extend(reading_data)
+        self.queued_datums -= len(data)
+        return readings, data
+
+    def flush(self):
+        """
+        Send everything currently queued. The readings of a failed batch are put back at the front of the queue
+        and False is returned
+        """
+        while True:
+            with self.condition:
+                readings, batch = self.next_batch()
+            if not readings:
+                return True
+            try:
+                if batch:
+                    response = self.client.put_metric_data(Namespace=self.namespace, MetricData=batch)
+                    logging.debug("Put {} datums to CloudWatch: {}".format(len(batch), response))
+                with self.condition:
+                    self.failing = False
+            except Exception as e:
+                logging.warning("Failed to put {} datums to CloudWatch, will retry: {}".format(len(batch), e))
+                with self.condition:
+                    self.queue.extendleft(reversed(readings))
+                    self.queued_datums += len(batch)
+                    self.failing = True
+                return False
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                if self.queued_datums < self.max_datums_per_request or self.failing:
+                    self.condition.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.flush_thread.join()
+        if not self.flush():
+            logging.warning("Failed to put {} readings to CloudWatch before closing".format(len(self.queue)))
+
+    def unpublished(self):
+        with self.condition:
+            readings = list(self.queue)
+            self.queue.clear()
+            self.queued_datums = 0
+            return readings
+
+
+class BufferedSink(Sink):
+    """
+    Decouples publishing from reading. Readings are queued in memory and published to the wrapped sink by a
+    background thread, so a slow or unreachable sink never blocks (or breaks) a device thread.
+
+    When the memory queue is full, readings are spilled to an append only spool file, if configured. Spooled
+    readings are replayed in order, with their original timestamps, once the sink accepts readings again. The
+    spool survives restarts. When the queue (or spool) reaches its maximum size, eviction decides whether the
+    'oldest' queued or the 'newest' reading is dropped. The spool file is compacted once as many of its lines were
+    replayed or evicted as are still pending, and on close, so it stays within twice max_spool_size. On close,
+    queued readings get up to drain_timeout seconds to be published.
+    """
+
+    evictions = ('oldest', 'newest')
+
+    def __init__(self, sink, max_queue_size=1000, spool_path=None, max_spool_size=100000, eviction='oldest',
+                 retry_interval=5, drain_timeout=5):
+        if eviction not in self.evictions:
+            raise ValueError("Unknown eviction policy: {}".format(eviction))
+        self.sink = sink
+        self.max_queue_size = max_queue_size
+        self.spool_path = spool_path
+        self.max_spool_size = max_spool_size
+        self.eviction = eviction
+        self.retry_interval = retry_interval
+        self.drain_timeout = drain_timeout
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.stopped = threading.Event()
+        # Every spooled reading is newer than every reading in the memory queue
+        self.spooled = 0
+        # Lines at the start of the spool file that were already replayed or evicted
+        self.spool_consumed = 0
+        self.spool_writer = None
+        self.spool_reader = None
+        if spool_path:
+            self.open_spool()
+
+        self.publish_thread = threading.Thread(target=self.run, name='BufferedPublish')
+        self.publish_thread.daemon = True
+        self.publish_thread.start()
+
+    def open_spool(self):
+        self.spool_writer = open(self.spool_path, 'a')
+        self.spool_reader = open(self.spool_path, 'r')
+        while self.spool_reader.readline():
+            self.spooled += 1
+        self.spool_reader.seek(0)
+        if self.spooled:
+            logging.info("Replaying {} spooled readings from {}".format(self.spooled, self.spool_path))
+
+    def connect(self):
+        self.sink.connect()
+
+    def spool(self, reading):
+        if self.spooled >= self.max_spool_size:
+            if self.eviction == 'newest':
+                metrics.inc('igrill_buffer_dropped_readings_total', device=reading.device_name)
+                logging.debug("Spool full, dropping reading from {}".format(reading.device_name))
+                return
+            self.pop_spool_head()
+        self.spool_writer.write(reading_to_json(reading) + '\n')
+        self.spool_writer.flush()
+        self.spooled += 1
+
+    def publish(self, reading):
+        with self.condition:
+            if self.spooled or len(self.queue) >= self.max_queue_size:
+                if self.spool_writer:
+                    self.spool(reading)
+                elif self.eviction == 'oldest':
+                    metrics.inc('igrill_buffer_dropped_readings_total', device=self.queue.popleft().device_name)
+                    self.queue.append(reading)
+                else:
+                    metrics.inc('igrill_buffer_dropped_readings_total', device=reading.device_name)
+                    logging.debug("Queue full, dropping reading from {}".format(reading.device_name))
+            else:
+                self.queue.append(reading)
+            self.condition.notify()
+
+    def pop_spool_head(self):
+        """Removes and returns the oldest spooled line. Call with the condition held"""
+        line = self.spool_reader.readline()
+        self.spooled -= 1
+        self.spool_consumed += 1
+        if not self.spooled:
+            # Fully replayed, start over with an empty spool
+            self.spool_writer.truncate(0)
+            self.spool_reader.seek(0)
+            self.spool_consumed = 0
+        elif self.spool_consumed >= self.spooled:
+            self.compact_spool()
+        return line
+
+    def compact_spool(self):
+        """Rewrites the spool file with only the pending lines. Call with the condition held"""
+        tmp_path = "{}.tmp".format(self.spool_path)
+        with open(tmp_path, 'w') as tmp_file:
+            tmp_file.write(self.spool_reader.read())
+        os.rename(tmp_path, self.spool_path)
+        self.spool_writer.close()
+        self.spool_reader.close()
+        self.spool_writer = open(self.spool_path, 'a')
+        self.spool_reader = open(self.spool_path, 'r')
+        logging.debug("Compacted spool {}, dropped {} replayed or evicted readings".format(
+            self.spool_path, self.spool_consumed))
+        self.spool_consumed = 0
+
+    def take_reading(self):
+        """Removes and returns the oldest unpublished reading. Call with the condition held"""
+        if self.queue:
+            return self.queue.popleft()
+        while self.spooled:
+            line = self.pop_spool_head()
+            try:
+                return reading_from_json(line)
+            except ValueError:
+                logging.warning("Skipping corrupt spooled reading: {}".format(line))
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue and not self.spooled:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                reading = self.take_reading()
+                if reading is None:
+                    continue
+
+            try:
+                with metrics.timer('igrill_sink_publish_seconds', device=reading.device_name):
+                    self.sink.publish(reading)
+                metrics.set('igrill_buffer_pending_readings', len(self.queue) + self.spooled)
+            except Exception as e:
+                metrics.inc('igrill_sink_publish_failures_total', device=reading.device_name)
+                logging.warning("Failed to publish reading from {}, retrying in {} seconds: {}".format(
+                    reading.device_name, self.retry_interval, e))
+                with self.condition:
+                    # Still the oldest reading, as everything newer is either behind it in the queue or spooled
+                    self.queue.appendleft(reading)
+                self.stopped.wait(self.retry_interval)
+
+    def drain(self, timeout):
+        """Waits up to timeout seconds for the memory queue to be published"""
+        deadline = time.time() + timeout
+        while self.queue and time.time() < deadline:
+            time.sleep(0.05)
+
+    def close(self):
+        self.drain(self.drain_timeout)
+        with self.condition:
+            self.running = False
+            self.stopped.set()
+            self.condition.notify()
+        self.publish_thread.join()
+        self.sink.close()
+
+        with self.condition:
+            # Readings the wrapped sink accepted but could not deliver are older than anything still queued
+            self.queue.extendleft(reversed(self.sink.unpublished()))
+            if self.queue and self.spool_writer:
+                self.persist_queue()
+            elif self.queue:
+                logging.warning("Dropping {} unpublished readings".format(len(self.queue)))
+            elif self.spool_consumed:
+                self.compact_spool()
+            if self.spool_writer:
+                self.spool_writer.close()
+                self.spool_reader.close()
+
+    def persist_queue(self):
+        """Writes the memory queue in front of the remaining spooled readings, so they are replayed on next start"""
+        tmp_path = "{}.tmp".format(self.spool_path)
+        with open(tmp_path, 'w') as tmp_file:
+            for reading in self.queue:
+                tmp_file.write(reading_to_json(reading) + '\n')
+            for line in self.spool_reader:
+                tmp_file.write(line)
+        os.rename(tmp_path, self.spool_path)
+        logging.info("Spooled {} unpublished readings to {}".format(len(self.queue), self.spool_path))
+        self.queue.clear()
+
+
+class Deadband(object):
+    """
+    Decides per metric whether a value changed enough to be published. A value is published when it moved at
+    least 'absolute' or 'percent' away from the last published value, or when max_interval seconds passed since
+    (heartbeat), but never sooner than min_interval seconds after the last one. State changes, like a probe being
+    unplugged or reporting missing_probe_value, are always published.
+    """
+
+    def __init__(self, absolute=None, percent=None, min_interval=0, max_interval=None):
+        self.absolute = absolute
+        self.percent = percent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @staticmethod
+    def numeric(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def changed(self, value, last_value):
+        if not (self.numeric(value) and self.numeric(last_value)):
+            return value != last_value
+        delta = abs(value - last_value)
+        if self.absolute is None and self.percent is None:
+            return delta > 0
+        return (self.absolute is not None and delta >= self.absolute) or \
+               (self.percent is not None and delta >= abs(last_value) * self.percent / 100.0)
+
+    def state_changed(self, value, last_value):
+        return self.numeric(value) != self.numeric(last_value) or (not self.numeric(value) and value != last_value)
+
+    def should_publish(self, value, timestamp, last):
+        if last is None:
+            return True
+        last_value, last_timestamp = last
+        if self.state_changed(value, last_value):
+            return True
+        elapsed = timestamp - last_timestamp
+        if elapsed < self.min_interval:
+            return False
+        if self.max_interval is not None and elapsed >= self.max_interval:
+            return True
+        return self.changed(value, last_value)
+
+
+class DeadbandSink(Sink):
+    """
+    Only passes on the metrics of a reading that changed according to the Deadband of their device (and metric),
+    dropping readings where nothing is left to publish. Devices without deadband settings are passed through.
+    """
+
+    def __init__(self, sink, deadband_config):
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.last_published = {}
+        self.deadbands = self.build(deadband_config)
+
+    @staticmethod
+    def build(deadband_config):
+        """Returns the Deadbands of every device and metric, raising TypeError for unknown settings"""
+        deadbands = {}
+        for device_name, settings in deadband_config.items():
+            settings = dict(settings)
+            metric_settings = settings.pop('metrics', {})
+            deadbands[device_name] = {None: Deadband(**settings)}
+            for metric, overrides in metric_settings.items():
+                deadbands[device_name][metric] = Deadband(**dict(settings, **overrides))
+        return deadbands
+
+    def configure(self, deadbands):
+        """Replaces the deadbands of all devices with ones returned by build(), keeping the last published values"""
+        with self.lock:
+            self.deadbands = deadbands
+
+    def connect(self):
+        self.sink.connect()
+
+    def filter(self, deadbands, device_name, metric, value, timestamp):
+        """Returns the value if it should be published, None otherwise. Call with the lock held"""
+        deadband = deadbands.get(metric, deadbands[None])
+        key = (device_name, metric)
+        if not deadband.should_publish(value, timestamp, self.last_published.get(key)):
+            return None
+        self.last_published[key] = (value, timestamp)
+        return value
+
+    def publish(self, reading):
+        deadbands = self.deadbands.get(reading.device_name)
+        if deadbands is None:
+            self.sink.publish(reading)
+            return
+
+        with self.lock:
+            temperatures = {}
+            for i, temperature in reading.temperatures.items():
+                # False (no probe, not published) is tracked too, so plugging a probe back in counts as a change
+                value = self.filter(deadbands, reading.device_name, "probe{}".format(i), temperature, reading.timestamp)
+                temperatures[i] = value if value is not None else False
+            battery = self.filter(deadbands, reading.device_name, 'battery', reading.battery, reading.timestamp)
+            heating_element = self.filter(deadbands, reading.device_name, 'heating_element',
+                                          bytes(reading.heating_element) if reading.heating_element else None,
+                                          reading.timestamp)
+
+        if not (any(temperatures.values()) or battery or heating_element):
+            logging.debug("Nothing changed enough to publish for {}".format(reading.device_name))
+            return
+        self.sink.publish(reading._replace(temperatures=temperatures, battery=battery,
+                                           heating_element=bytearray(heating_element) if heating_element else None))
+
+    def close(self):
+        self.sink.close()
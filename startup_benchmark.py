@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Measures the start up time and memory of the monitor for different config combinations: validating the config
+(--configtest), and starting up to the point where devices would connect. Every run is a fresh interpreter, so
+import time is included.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+# Modules that are only worth their import time and memory when the config uses them
+OPTIONAL_MODULES = ('bluepy', 'paho', 'boto3', 'http.server', 'asyncio')
+
+DEVICES = [{'name': 'grill', 'type': 'igrill_v2', 'address': '70:91:8F:00:00:01', 'topic': 'grill', 'interval': 20}]
+
+SCENARIOS = [
+    ('mqtt', {'mqtt': {'host': 'localhost', 'aws_cloudwatch_metrics': False}}),
+    ('mqtt json, deadband', {'mqtt': {'host': 'localhost', 'aws_cloudwatch_metrics': False, 'payload_format': 'json'},
+                             'devices': [dict(DEVICES[0], deadband={'absolute': 0.5})]}),
+    ('cloudwatch', {'mqtt': {'host': 'localhost', 'aws_cloudwatch_metrics': True}}),
+    ('mqtt, history, session log, metrics', {'mqtt': {'host': 'localhost', 'aws_cloudwatch_metrics': False},
+                                             'history': {'port': 0},
+                                             'session_log': {'directory': '{tmp}/sessions'},
+                                             'metrics': {'dump_path': '{tmp}/metrics.prom'}}),
+    ('mqtt, influxdb', {'mqtt': {'host': 'localhost', 'aws_cloudwatch_metrics': False},
+                        'influxdb': {'url': 'http://localhost:8086/write?db=igrill'}}),
+]
+
+
+def start_child(config_directory):
+    """Runs the start up of monitor.main up to connecting the devices, without connecting to a broker"""
+    from config import Config, strip_config
+    import metrics
+    import utils
+
+    def mqtt_client(mqtt_config):
+        import paho.mqtt.client as mqtt
+        return mqtt.Client()
+
+    utils.mqtt_init = mqtt_client
+    config = Config(config_directory, utils.config_requirements, utils.config_defaults)
+    if 'metrics' in config.get_config():
+        metrics.start(**strip_config(config.get_config()['metrics'], ['host', 'port', 'dump_path', 'dump_interval']))
+    sink = utils.create_sink(config.get_config())
+    utils.get_device_monitors(config.get_config('devices'), sink)
+    print(json.dumps([module for module in OPTIONAL_MODULES if module in sys.modules]))
+
+
+def measure(command, env):
+    """Runs the command, returning its wall time, max rss in MB and output"""
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+    output = process.stdout.read()
+    _, _, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024.0, output.decode('utf-8').strip()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    print("{:<38} {:<12} {:>9} {:>9}  {}".format('config', 'phase', 'time', 'max rss', 'optional modules loaded'))
+    for name, scenario in SCENARIOS:
+        tmp = tempfile.mkdtemp(prefix='igrill-startup-')
+        try:
+            config = json.loads(json.dumps(scenario).replace('{tmp}', tmp))
+            config.setdefault('devices', DEVICES)
+            with open(os.path.join(tmp, 'config.yaml'), 'w') as config_file:
+                yaml.safe_dump(config, config_file)
+
+            phases = [('configtest', [sys.executable, os.path.join(here, 'monitor.py'), '--configtest',
+                                      '-c', tmp, '-l', 'ERROR']),
+                      ('start', [sys.executable, os.path.abspath(__file__), '--child', tmp])]
+            for phase, command in phases:
+                runs = [measure(command, env) for _ in range(options.runs)]
+                print("{:<38} {:<12} {:>6.0f} ms {:>6.1f} MB  {}".format(
+                    name, phase, median([r[0] for r in runs]) * 1000, median([r[1] for r in runs]),
+                    ', '.join(json.loads(runs[-1][2])) if phase == 'start' and runs[-1][2] else '-'))
+        finally:
+            shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start up time and memory of the monitor')
+    parser.add_argument('-n', '--runs', action='store', dest='runs', default=5, type=int,
+                        help='Runs per config and phase, the median is reported, default: 5')
+    parser.add_argument('--child', action='store', dest='child', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        start_child(options.child)
+    else:
+        run(options)
+
+
+if __name__ == '__main__':
+    main()
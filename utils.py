@@ -1,23 +1,116 @@
-from builtins import range
 from config import strip_config
-from config import Config
-import argparse
-from igrill import IGrillMiniPeripheral, IGrillV2Peripheral, IGrillV3Peripheral, Pulse2000Peripheral, DeviceThread
 import logging
-import paho.mqtt.client as mqtt
-import boto3
+from sinks import Reading, BufferedSink, DeadbandSink, MqttSink, MultiSink, CloudWatchSink
 import time
 
+# paho, and bluepy through igrill, are imported by the functions using them, so validating the config or building
+# a CloudWatch only setup does not load them
+
+# 'auto' detects the type from the advertisement, see presence
+DEVICE_TYPES = ('igrill_mini', 'igrill_v2', 'igrill_v3', 'pulse_2000', 'auto', 'simulated_igrill_mini',
+                'simulated_igrill_v2', 'simulated_igrill_v3', 'simulated_pulse_2000')
+
+# Settings of a deadband, which its metrics can override
+DEADBAND_SETTINGS = {'absolute': (int, float), 'percent': (int, float), 'min_interval': int, 'max_interval': int}
+DEADBAND_METRICS = ('probe1', 'probe2', 'probe3', 'probe4', 'battery', 'heating_element')
+
 config_requirements = {
     'specs': {
         'required_entries': {'devices': list, 'mqtt': dict},
+        'optional_entries': {'handle_cache': str, 'bluetooth': dict, 'reconnect': dict, 'buffer': dict,
+                             'history': dict, 'session_log': dict, 'metrics': dict, 'presence': dict,
+                             'influxdb': dict},
     },
     'children': {
+        'influxdb': {
+            'specs': {
+                'required_entries': {'url': str},
+                'optional_entries': {'measurement': str, 'precision': str, 'batch_size': int, 'flush_interval': int,
+                                     'max_queue_size': int, 'gzip': bool, 'token': str, 'username': str,
+                                     'password': str, 'timeout': int},
+                'choices': {'precision': ('s', 'ms', 'us', 'ns')}
+            }
+        },
+        'presence': {
+            'specs': {
+                'optional_entries': {'adapter': int, 'scan_duration': int, 'scan_pause': int, 'timeout': int,
+                                     'passive': bool}
+            }
+        },
+        'metrics': {
+            'specs': {
+                'optional_entries': {'host': str, 'port': int, 'dump_path': str, 'dump_interval': int}
+            }
+        },
+        'session_log': {
+            'specs': {
+                'required_entries': {'directory': str},
+                'optional_entries': {'records_per_file': int, 'flush_interval': int}
+            }
+        },
+        'history': {
+            'specs': {
+                'optional_entries': {'capacity': int, 'host': str, 'port': int}
+            }
+        },
+        'buffer': {
+            'specs': {
+                'optional_entries': {'max_queue_size': int, 'spool_path': str, 'max_spool_size': int,
+                                     'eviction': str, 'retry_interval': int, 'drain_timeout': int},
+                'choices': {'eviction': BufferedSink.evictions}
+            }
+        },
+        'reconnect': {
+            'specs': {
+                'optional_entries': {'initial_delay': int, 'max_delay': int, 'max_attempts': int}
+            }
+        },
+        'bluetooth': {
+            'specs': {
+                'optional_entries': {'adapters': list, 'max_concurrent_connections': int}
+            },
+            'children': {
+                'adapters': {
+                    'specs': {
+                        'list_type': int
+                    }
+                }
+            }
+        },
         'devices': {
             'specs': {
                 'required_entries': {'name': str, 'type': str, 'address': str, 'topic': str, 'interval': int},
-                'optional_entries': {'publish_missing_probes': bool, 'missing_probe_value': str},
-                'list_type': dict
+                'optional_entries': {'publish_missing_probes': bool, 'missing_probe_value': str,
+                                     'notifications': bool, 'adapter': int, 'simulation': dict, 'deadband': dict,
+                                     'adaptive_interval': dict},
+                'list_type': dict,
+                'defaults': {'publish_missing_probes': False, 'missing_probe_value': 'missing'},
+                'choices': {'type': DEVICE_TYPES},
+                'formats': {'address': 'mac'},
+                'unique': ('name',)
+            },
+            'children': {
+                'adaptive_interval': {
+                    'specs': {
+                        'required_entries': {'min_interval': int, 'max_interval': int},
+                        'optional_entries': {'rate': (int, float), 'margin': (int, float), 'thresholds': dict,
+                                             'read_thresholds': bool}
+                    }
+                },
+                'deadband': {
+                    'specs': {
+                        'optional_entries': dict(DEADBAND_SETTINGS, metrics=dict)
+                    },
+                    'children': {
+                        'metrics': {
+                            'specs': {
+                                'optional_entries': {metric: dict for metric in DEADBAND_METRICS}
+                            },
+                            'children': {metric: {'specs': {'optional_entries': DEADBAND_SETTINGS}}
+                                         for metric in DEADBAND_METRICS}
+                        }
+                    }
+                }
             }
         },
         'mqtt': {
@@ -26,8 +119,12 @@ config_requirements = {
                                      'aws_cloudwatch_metrics': bool},
                 'optional_entries': {'port': int,
                                      'keepalive': int,
+                                     'payload_format': str,
+                                     'aws_cloudwatch_namespace': str,
+                                     'aws_cloudwatch_flush_interval': int,
                                      'auth': dict,
-                                     'tls': dict}
+                                     'tls': dict},
+                'combinations': {'payload_format': ('+', MqttSink.payload_formats)}
             },
             'children': {
                 'auth': {
@@ -57,18 +154,6 @@ config_defaults = {
     }
 }
 
-parser = argparse.ArgumentParser(description='Monitor bluetooth igrill devices, and export to MQTT')
-parser.add_argument('-c', '--config', action='store', dest='config_directory', default='.',
-                    help='Set config directory, default: \'.\'')
-parser.add_argument('-l', '--log-level', action='store', dest='log_level', default='INFO',
-                    help='Set log level, default: \'info\'')
-parser.add_argument('-d', '--log-destination', action='store', dest='log_destination', default='',
-                    help='Set log destination (file), default: \'\' (stdout)')
-parser.add_argument('--configtest', help='Parse config only',
-                    action="store_true")
-options = parser.parse_args()
-
-
 def log_setup(log_level, logfile):
     """Setup application logging"""
 
@@ -97,6 +182,7 @@ def log_setup(log_level, logfile):
 
 def mqtt_init(mqtt_config):
     """Setup mqtt connection"""
+    import paho.mqtt.client as mqtt
     mqtt_client = mqtt.Client()
 
     if 'auth' in mqtt_config:
@@ -110,52 +196,81 @@ def mqtt_init(mqtt_config):
         else:
             mqtt_client.tls_set()
 
-    mqtt_client.connect(**strip_config(mqtt_config, ['host', 'port', 'keepalive']))
+    # The network loop started by MqttSink connects (and reconnects) in the background, so a broker that is down
+    # at startup does not keep the devices from being read. Readings published meanwhile are buffered.
+    mqtt_client.connect_async(**strip_config(mqtt_config, ['host', 'port', 'keepalive']))
     return mqtt_client
 
-def putMetricData(metricName, value, currentTimestamp):
-    cwClient = boto3.client('cloudwatch')
-    response = cwClient.put_metric_data(
-        Namespace='iGrill',
-        MetricData=[
-            {
-                'MetricName': metricName,
-                'Timestamp': currentTimestamp,
-                'Value': value
-            }
-        ]
-    )
+# Parts of the sink next to the MQTT/CloudWatch connection, in publishing order
+LOCAL_SINKS = ('history', 'session_log', 'influxdb')
 
-    logging.debug("putted metric data")
-    logging.debug(response)
 
-    time.sleep(6)
+def sink_parts(config):
+    """
+    The config each part of the sink is built from, by name: 'upstream' (the MQTT/CloudWatch connection and its
+    buffer), and the configured local sinks
+    """
+    parts = {'upstream': {'mqtt': config['mqtt'], 'buffer': config.get('buffer')}}
+    if 'history' in config:
+        parts['history'] = config['history']
+    if 'session_log' in config:
+        parts['session_log'] = config['session_log']
+    if 'influxdb' in config:
+        parts['influxdb'] = config['influxdb']
+    return parts
 
-def publish(temperatures, battery, heating_element, client, base_topic, device_name):
-    aws_options = parser.parse_args()
-    aws_config = Config(aws_options.config_directory, config_requirements, config_defaults)
-    aws_mqtt_config = aws_config.get_config('mqtt')
 
-    if 'aws_cloudwatch_metrics' in aws_mqtt_config and aws_mqtt_config['aws_cloudwatch_metrics'] == True:
-        logging.debug("using aws cloudwatch metrics")
-        currentTimestamp = time.time()
+def create_sink_part(name, part_config):
+    """Builds one part of the sink from its config, see sink_parts"""
+    if name == 'upstream':
+        mqtt_config = part_config['mqtt']
+        if mqtt_config.get('aws_cloudwatch_metrics'):
+            sink = CloudWatchSink(**{k[len('aws_cloudwatch_'):]: v for k, v in
+                                     strip_config(mqtt_config, ['aws_cloudwatch_namespace',
+                                                                'aws_cloudwatch_flush_interval']).items()})
+        else:
+            sink = MqttSink(mqtt_init(mqtt_config), **strip_config(mqtt_config, ['payload_format']))
+        return BufferedSink(sink, **strip_config(part_config['buffer'] or {},
+                                                 ['max_queue_size', 'spool_path', 'max_spool_size', 'eviction',
+                                                  'retry_interval', 'drain_timeout']))
+    if name == 'history':
+        from history import HistorySink
+        return HistorySink(**strip_config(part_config or {}, ['capacity', 'host', 'port']))
+    if name == 'session_log':
+        from sessionlog import SessionLogSink
+        return SessionLogSink(**strip_config(part_config or {}, ['directory', 'records_per_file', 'flush_interval']))
+    if name == 'influxdb':
+        from influx import InfluxSink
+        # Not stripped of falsy values, so gzip can be disabled
+        return InfluxSink(**{k: v for k, v in (part_config or {}).items() if v is not None})
+    raise ValueError("Unknown sink part: {}".format(name))
 
-        for i in range(1, 5):
-            if temperatures[i]:
-                putMetricData("probe" + str(i), temperatures[i], currentTimestamp)
-        if battery:
-            putMetricData("battery", battery, currentTimestamp)
 
-    else:
-        logging.debug("using legacy mqtt")
-        for i in range(1, 5):
-            if temperatures[i]:
-                client.publish("{0}/{1}/probe{2}".format(base_topic, device_name, i), temperatures[i])
+def deadband_config(config):
+    """Deadband settings by device name, for the devices that have them"""
+    return {d['name']: strip_config(d['deadband'], ['absolute', 'percent', 'min_interval', 'max_interval', 'metrics'])
+            for d in config.get('devices') or [] if d.get('deadband')}
 
-        if battery:
-            client.publish("{0}/{1}/battery".format(base_topic, device_name), battery)
-        if heating_element:
-            client.publish("{0}/{1}/heating_element".format(base_topic, device_name), heating_element)
+
+def assemble_sink(upstream, parts):
+    """Combines the (deadband filtered) upstream sink with the local sinks in parts"""
+    # Local sinks and InfluxDB get every reading, not only what passed the deadband
+    sinks = [upstream] + [parts[name] for name in LOCAL_SINKS if name in parts]
+    return MultiSink(sinks) if len(sinks) > 1 else upstream
+
+
+def create_sink(config):
+    """Build the sink readings are published to, based on the (already validated) config"""
+    parts = {name: create_sink_part(name, part_config) for name, part_config in sink_parts(config).items()}
+    upstream = parts['upstream']
+    deadbands = deadband_config(config)
+    if deadbands:
+        upstream = DeadbandSink(upstream, deadbands)
+    return assemble_sink(upstream, parts)
+
+
+def publish(temperatures, battery, heating_element, sink, base_topic, device_name, device_type=None):
+    sink.publish(Reading(time.time(), device_name, base_topic, temperatures, battery, heating_element, device_type))
 
 
 def get_devices(device_config):
@@ -163,6 +278,7 @@ def get_devices(device_config):
         logging.warn('No devices in config')
         return {}
 
+    from igrill import IGrillMiniPeripheral, IGrillV2Peripheral, IGrillV3Peripheral, Pulse2000Peripheral
     device_types = {'igrill_mini': IGrillMiniPeripheral,
                     'igrill_v2': IGrillV2Peripheral,
                     'igrill_v3': IGrillV3Peripheral,
@@ -171,10 +287,48 @@ def get_devices(device_config):
     return [device_types[d['type']](**strip_config(d, ['address', 'name'])) for d in device_config]
 
 
-def get_device_threads(device_config, mqtt_config, run_event):
+def load_device_types(device_config):
+    """Registers optional device types used by the config"""
+    if any(d['type'].startswith('simulated_') for d in device_config):
+        import simulator
+        simulator.register(device_config)
+
+
+def get_device_threads(device_config, sink, run_event, handle_cache=None, scheduler=None, reconnect_policy=None):
     if device_config is None:
         logging.warn('No devices in config')
         return {}
 
-    return [DeviceThread(ind, mqtt_config, run_event, **d) for ind, d in
-            enumerate(device_config)]
+    from igrill import DeviceThread
+    load_device_types(device_config)
+    # All threads share one sink, and with that one MQTT connection or CloudWatch batch queue
+    return [DeviceThread(ind, sink, run_event, handle_cache=handle_cache,
+                         scheduler=scheduler, reconnect_policy=reconnect_policy, **d)
+            for ind, d in enumerate(device_config)]
+
+
+def create_presence(config, device_config):
+    """
+    Creates the scanner for advertising devices, if presence is configured, to be started once the connection
+    scheduler exists. An empty 'presence:' uses the defaults
+    """
+    if 'presence' not in config:
+        return None
+    from presence import PresenceScanner
+    # Simulated devices are scanned for by the simulator, which has to be registered before scanning starts
+    load_device_types(device_config or [])
+    # Not stripped of falsy values, a scan_pause of 0 scans without pausing
+    return PresenceScanner(**{k: v for k, v in (config['presence'] or {}).items() if v is not None})
+
+
+def get_device_monitors(device_config, sink, handle_cache=None, scheduler=None, reconnect_policy=None,
+                        presence=None):
+    if device_config is None:
+        logging.warn('No devices in config')
+        return []
+
+    from igrill import DeviceMonitor
+    load_device_types(device_config)
+    return [DeviceMonitor(sink, handle_cache=handle_cache, scheduler=scheduler, reconnect_policy=reconnect_policy,
+                          presence=presence, **d)
+            for d in device_config]